@@ -0,0 +1,169 @@
+# Async download engine for chunks, used with --engine async.
+# One event loop with a keep-alive connection pool (and HTTP/2 multiplexing if the CDN supports it)
+# replaces the thread pool, so many more chunks can be in flight with a single OS thread.
+# Blocking work (decryption, and save: writing to disk, ffmpeg's stdin, an upload or the segment cache) runs in
+# the default executor, so a slow consumer doesn't stall every other download on the loop.
+import asyncio
+import contextlib
+import importlib.util
+import time
+from urllib.parse import urlsplit
+
+from Metrics import Metrics
+from utils import SegmentBuffer, StreamDecryptor, chunk_filename, retry_delay, throttle_reason
+
+try:
+    import httpx
+except ImportError:
+    httpx = None
+
+
+class AsyncDownloader:
+    def __init__(self, controller, per_host=None, headers=None, http2=True, rate_limiter=None, metrics=None, edge_pool=None,
+                 get_key=None, debug=False):
+        """
+        :param controller: AIMDController deciding how many chunks are downloading at the same time
+        :param per_host: max number of concurrent requests to a single host (default: controller.maximum)
+        :param headers: headers to send with every request
+        :param http2: use HTTP/2 if the server supports it (requires the h2 package)
+        :param rate_limiter: RateLimiter for the total download rate
+        :param metrics: Metrics to record the chunks and retries in
+        :param edge_pool: EdgePool to spread the requests over several CDN edges
+        :param get_key: function returning a Future of the AES key at a URL (fetching it again if it failed before)
+        :param debug: print debug info
+        """
+        if httpx is None:
+            raise ImportError("--engine async requires httpx. Install it with: pip install httpx[http2]")
+        self.controller = controller
+        self.concurrency = controller.maximum
+        self.per_host = per_host or self.concurrency
+        self.headers = headers or {}
+        self.http2 = http2 and importlib.util.find_spec('h2') is not None
+        if http2 and not self.http2:
+            print("[WARN] h2 is not installed, falling back to HTTP/1.1. Install it with: pip install httpx[http2]")
+        self.rate_limiter = rate_limiter
+        self.metrics = metrics or Metrics()
+        self.edge_pool = edge_pool
+        self.get_key = get_key
+        self.debug = debug
+        self.host_limits = {}
+
+    def host_limit(self, url):
+        host = urlsplit(url).netloc
+        if host not in self.host_limits:
+            self.host_limits[host] = asyncio.Semaphore(self.per_host)
+        return self.host_limits[host]
+
+    @contextlib.asynccontextmanager
+    async def slot(self):
+        """Wait until the controller allows another request."""
+        # the controller may be shared with other jobs (batch mode), whose releases don't wake us up, so poll as well.
+        while not self.controller.try_acquire():
+            async with self.slot_changed:
+                with contextlib.suppress(asyncio.TimeoutError):
+                    await asyncio.wait_for(self.slot_changed.wait(), 0.1)
+        try:
+            yield
+        finally:
+            self.controller.release()
+            async with self.slot_changed:
+                self.slot_changed.notify_all()
+
+    async def download(self, client, index, chunk_url, key_url, iv, save):
+        filename = chunk_filename(chunk_url)
+        retry_count = 0
+        while retry_count < 10:
+            if retry_count > 0:
+                print(f"Retry {retry_count} for {filename}...")
+                await asyncio.sleep(retry_delay(retry_count))
+            host = None
+            try:
+                # the key is fetched in the background, and looked up on every attempt so a failed fetch is retried
+                decryptor = StreamDecryptor(await asyncio.wrap_future(self.get_key(key_url)), iv) if key_url is not None else None
+                # with --edges, every attempt may go to a different edge
+                url, host = self.edge_pool.pick(chunk_url) if self.edge_pool else (chunk_url, None)
+                async with self.slot(), self.host_limit(url):
+                    start = time.time()
+                    # stream the chunk into a bounded buffer, hashing (and decrypting) it on the way
+                    buffer = SegmentBuffer()
+                    async with client.stream('GET', url) as r:
+                        r.raise_for_status()
+                        # sometimes the response is "chunked" and doesn't have a content-length header
+                        expected_size = int(r.headers.get('Content-Length', -1))
+                        actual_size = 0
+                        async for data in r.aiter_bytes(SegmentBuffer.block_size):
+                            actual_size += len(data)
+                            if decryptor:
+                                await asyncio.to_thread(lambda: buffer.write(decryptor.update(data)))
+                            else:
+                                buffer.write(data)
+                    latency = time.time() - start
+                if (actual_size == expected_size) or (expected_size == -1 and actual_size > 0):
+                    if decryptor:
+                        await asyncio.to_thread(lambda: buffer.write(decryptor.finalize()))
+                    self.controller.success(latency, actual_size)
+                    self.edge_pool and self.edge_pool.success(host, latency, actual_size)
+                    self.metrics.record_segment(url, latency, actual_size, decryptor and decryptor.seconds)
+                    if self.rate_limiter:
+                        await asyncio.sleep(self.rate_limiter.reserve(actual_size))
+                    await asyncio.to_thread(save, index, chunk_url, buffer)
+                    return
+                buffer.close()
+                print(f"[WARN] Size mismatch: expected {expected_size}, got {actual_size}")
+                self.controller.failure('size mismatch')
+                self.edge_pool and self.edge_pool.failure(host)
+                self.metrics.inc('retries', reason='size mismatch')
+                retry_count += 1
+            except Exception as e:
+                print(f"\nError downloading chunk: {e}")
+                self.edge_pool and self.edge_pool.failure(host)
+                reason = throttle_reason(e)
+                if reason:
+                    self.controller.failure(reason)
+                self.metrics.inc('retries', reason=reason or type(e).__name__)
+                retry_count += 1
+        raise Exception(f"Failed to download chunk {filename} after 10 retries")
+
+    async def _run(self, jobs, save, progress):
+        limits = httpx.Limits(max_connections=self.concurrency, max_keepalive_connections=self.concurrency)
+        self.debug and print(f'[DEBUG] async engine: concurrency={self.concurrency}, per_host={self.per_host}, http2={self.http2}')
+        self.slot_changed = asyncio.Condition()
+        async with httpx.AsyncClient(http2=self.http2, limits=limits, headers=self.headers, timeout=8) as client:
+            queue = asyncio.Queue()
+            for job in jobs:
+                queue.put_nowait(job)
+            total = len(jobs)
+            finished = 0
+
+            async def worker():
+                nonlocal finished
+                while not queue.empty():
+                    index, chunk_url, key_url, iv = queue.get_nowait()
+                    await self.download(client, index, chunk_url, key_url, iv, save)
+                    finished += 1
+                    progress and print(f'\r{finished}/{total} chunks downloaded.      ', end='')
+
+            workers = [asyncio.create_task(worker()) for _ in range(min(self.concurrency, total))]
+            try:
+                await asyncio.gather(*workers)
+            except Exception as e:
+                print('\nFatal error:', e)
+                for w in workers:
+                    w.cancel()
+                return False
+        return True
+
+    def run(self, jobs, save, progress=True):
+        """
+        Download the chunks.
+
+        :param jobs: list of (index, chunk_url, key_url, iv), where key_url is None if the chunk isn't encrypted
+        :param save: called with (index, chunk_url, SegmentBuffer) for each downloaded chunk
+        :param progress: print the progress
+        :returns: True if all chunks are downloaded
+        """
+        try:
+            return asyncio.run(self._run(jobs, save, progress))
+        except KeyboardInterrupt:
+            print("\nDownload interrupted by user. Aborting...")
+            return False
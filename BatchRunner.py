@@ -0,0 +1,150 @@
+# Batch mode: archive many Spaces/Broadcasts from one process.
+# All jobs share one authenticated session (so one guest token and one connection pool),
+# one concurrency controller and one rate limiter, which act as a global budget.
+# Entries are run by a fixed number of worker threads, so a long queue doesn't start (and hit the API for) every job at once.
+# Scheduled Spaces don't take a worker while they wait: the main loop keeps them in a heap by the time of their
+# next check, and hands them to the workers once they have started.
+import concurrent.futures
+import hashlib
+import heapq
+import queue
+import threading
+import time
+from datetime import timedelta
+from pathlib import Path
+from urllib.parse import urlsplit
+
+from TwitterSpace import TwitterSpace
+from utils import AIMDController, RateLimiter, requests_retry_session
+
+
+class BatchRunner:
+    def __init__(self, queue_file, jobs=2, follow=False, threads=20, adaptive=True, limit_rate=None, debug=False, **options):
+        """
+        :param queue_file: text file with one Space/Broadcast ID, URL or master/dynamic playlist URL per line
+        :param jobs: max number of spaces being downloaded at the same time. Scheduled spaces wait without taking a slot.
+        :param follow: keep watching queue_file for new lines (daemon mode)
+        :param threads: max number of concurrent chunk downloads, shared by all jobs
+        :param adaptive: adapt the number of concurrent chunk downloads
+        :param limit_rate: max total download rate in bytes/s
+        :param debug: print debug info
+        :param options: other TwitterSpace options applied to every job (path, filename_format, cookies, etc.)
+        """
+        self.queue_file = Path(queue_file)
+        # finished entries are appended here, so they are skipped when the batch is started again.
+        self.done_file = self.queue_file.with_name(self.queue_file.name + '.done')
+        self.follow = follow
+        self.debug = debug
+        self.options = options
+        self.session = requests_retry_session(pool_maxsize=max(threads, 10))
+        self.controller = AIMDController(threads, adaptive=adaptive, debug=debug)
+        self.rate_limiter = RateLimiter(limit_rate) if limit_rate else None
+        self.jobs = jobs
+        self.pending = queue.Queue()
+        self.scheduled = []  # (time of the next check, entry) of the spaces that haven't started yet
+        self.waiting = set()
+        self.client = None
+        self.key_fetcher = concurrent.futures.ThreadPoolExecutor(max_workers=4)
+        self.done_lock = threading.Lock()
+        self.seen = set()
+        if self.done_file.exists():
+            self.seen.update(self.done_file.read_text(encoding='utf-8').split())
+
+    def read_queue(self):
+        """Return the entries in the queue file that haven't been started yet."""
+        entries = []
+        for line in self.queue_file.read_text(encoding='utf-8').splitlines():
+            entry = line.split('#')[0].strip()
+            if entry and entry not in self.seen:
+                self.seen.add(entry)
+                entries.append(entry)
+        return entries
+
+    def api_client(self):
+        """A TwitterSpace only used for API requests, which shares the session (and so the auth) with the download jobs."""
+        if self.client is None:
+            self.client = TwitterSpace(session=self.session, debug=self.debug, **self.options)
+            self.client.authenticate()
+        return self.client
+
+    def submit(self, entry):
+        """Queue entry for download, or park it in the heap if it's a space that hasn't started yet."""
+        if '.m3u8' not in entry:
+            try:
+                client = self.api_client()
+                client.type = self.options.get('type_', 'space')
+                client.parse_url_or_space_id(entry)
+                client.update_metadata(client.space_id)
+            except (Exception, SystemExit) as e:
+                # the job tries again, and reports it if it still fails
+                self.debug and print(f"[DEBUG] failed to check the state of {entry}: {e!r}")
+            else:
+                if client.state == 'NotStarted':
+                    time_to_start = client.started_at / 1000 - time.time() if client.started_at else 0
+                    if entry not in self.waiting:
+                        self.waiting.add(entry)
+                        print(f"[Batch] {entry} is scheduled, waiting for it to start (in {timedelta(seconds=max(int(time_to_start), 0))})")
+                    # check every 10 seconds around the start, and at least every 10 minutes before (the time can change)
+                    heapq.heappush(self.scheduled, (time.time() + min(max(time_to_start, 10), 600), entry))
+                    return
+        self.waiting.discard(entry)
+        self.pending.put(entry)
+
+    def check_scheduled(self):
+        """Check the scheduled spaces that are due, and queue the ones that have started."""
+        while self.scheduled and self.scheduled[0][0] <= time.time():
+            _, entry = heapq.heappop(self.scheduled)
+            self.submit(entry)
+
+    def run_job(self, entry):
+        if '.m3u8' in entry:
+            # the default filename for playlist URLs is based on the current time, which would clash between jobs.
+            type_ = 'space' if '/audio-space/' in entry else 'broadcast'
+            filename = f'twitter_{type_}_' + hashlib.sha1(urlsplit(entry).path.encode()).hexdigest()[:16]
+            kwargs = dict(dyn_url=entry, filename=filename)
+        else:
+            kwargs = dict(url_or_space_id=entry)
+        try:
+            space = TwitterSpace(**kwargs, **self.options, threads=self.controller.maximum, debug=self.debug,
+                                 session=self.session, controller=self.controller, rate_limiter=self.rate_limiter,
+                                 key_fetcher=self.key_fetcher)
+        except (Exception, SystemExit) as e:
+            print(f"\n[Batch] {entry} failed: {e!r}")
+            return
+        if space.output is None:
+            print(f"\n[Batch] {entry} was not downloaded.")
+            return
+        with self.done_lock:
+            with self.done_file.open('a', encoding='utf-8') as f:
+                f.write(entry + '\n')
+        print(f"\n[Batch] {entry} finished.")
+
+    def worker(self):
+        while True:
+            entry = self.pending.get()
+            try:
+                print(f"[Batch] Starting {entry}")
+                self.run_job(entry)
+            finally:
+                self.pending.task_done()
+
+    def start_workers(self):
+        # daemon threads rather than a ThreadPoolExecutor, so Ctrl+C doesn't wait for the running jobs to finish
+        for _ in range(self.jobs):
+            threading.Thread(target=self.worker, daemon=True).start()
+
+    def run(self):
+        self.start_workers()
+        try:
+            while True:
+                for entry in self.read_queue():
+                    self.submit(entry)
+                self.check_scheduled()
+                if not self.follow and not self.scheduled:
+                    self.pending.join()
+                    break
+                time.sleep(5)
+        except KeyboardInterrupt:
+            print("\n[Batch] Aborted by user.")
+            return
+        print("[Batch] All jobs finished.")
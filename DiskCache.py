@@ -0,0 +1,51 @@
+# Small on-disk cache for guest tokens, users and space/broadcast metadata, shared between runs and batch jobs.
+import json
+import sqlite3
+import threading
+import time
+from pathlib import Path
+
+
+class DiskCache:
+    def __init__(self, cache_dir=None, max_entries=1000):
+        """
+        Key-value cache with expiry, stored in an SQLite file so several processes can use it at the same time.
+        When there are more than max_entries, the least recently used ones are evicted.
+
+        :param cache_dir: directory of the cache file (default: ~/.cache/tslazer)
+        :param max_entries: max number of entries to keep
+        """
+        cache_dir = Path(cache_dir) if cache_dir else Path.home() / '.cache' / 'tslazer'
+        cache_dir.mkdir(parents=True, exist_ok=True)
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(cache_dir / 'cache.sqlite', timeout=10, check_same_thread=False)
+        with self.lock, self.db:
+            self.db.execute('CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value TEXT, expires REAL, accessed REAL)')
+            self.db.execute('DELETE FROM cache WHERE expires <= ?', (time.time(),))
+
+    def get(self, key):
+        """
+        :returns: the cached value, or None if it's missing or expired
+        """
+        now = time.time()
+        with self.lock, self.db:
+            row = self.db.execute('SELECT value FROM cache WHERE key = ? AND expires > ?', (key, now)).fetchone()
+            if row is None:
+                return None
+            self.db.execute('UPDATE cache SET accessed = ? WHERE key = ?', (now, key))
+        return json.loads(row[0])
+
+    def set(self, key, value, ttl):
+        """
+        :param value: any JSON-serializable value
+        :param ttl: seconds until the entry expires
+        """
+        now = time.time()
+        with self.lock, self.db:
+            self.db.execute('INSERT OR REPLACE INTO cache VALUES (?, ?, ?, ?)', (key, json.dumps(value), now + ttl, now))
+            self.db.execute('DELETE FROM cache WHERE key IN (SELECT key FROM cache ORDER BY accessed DESC LIMIT -1 OFFSET ?)', (self.max_entries,))
+
+    def delete(self, key):
+        with self.lock, self.db:
+            self.db.execute('DELETE FROM cache WHERE key = ?', (key,))
@@ -0,0 +1,128 @@
+# Spread chunk downloads over several CDN edges serving the same /Transcoding/v1/hls/... path, used with --edges.
+# Playlists point at one edge (e.g. prod-fastly-ap-northeast-1.video.pscp.tv), and the same chunks are also
+# on the other providers' edges of the region (e.g. prod-ec-ap-northeast-1.video.pscp.tv).
+import random
+import re
+import threading
+import time
+from urllib.parse import urlsplit
+
+
+def derive_edges(host):
+    """Alternate edge hostnames for a pscp.tv edge, i.e. the same region on the other CDN providers."""
+    m = re.fullmatch(r'prod-(fastly|ec)-(.+)\.video\.pscp\.tv', host)
+    if not m:
+        return []
+    return [f'prod-{provider}-{m[2]}.video.pscp.tv' for provider in ('fastly', 'ec') if provider != m[1]]
+
+
+class Edge:
+    def __init__(self, host):
+        self.host = host
+        self.latency = None   # EWMA of the time to download a chunk
+        self.throughput = None  # EWMA of bytes/s
+        self.samples = 0
+        self.in_flight = 0
+        self.failures = 0     # consecutive failures
+        self.evicted_until = 0
+
+    def cost(self):
+        # unmeasured edges look cheap, so they get tried
+        return (self.latency or 0) * (self.in_flight + 1)
+
+
+class EdgePool:
+    def __init__(self, url, hosts=(), session=None, evict_after=3, slow_factor=4, cooldown=60, debug=False):
+        """
+        :param url: a chunk (or playlist) URL on the edge from the playlist
+        :param hosts: extra edge hostnames to use, besides the derived ones
+        :param session: requests session used to probe the edges
+        :param evict_after: evict an edge after this many consecutive failures
+        :param slow_factor: evict an edge whose latency is this many times the best edge's
+        :param cooldown: seconds before an evicted edge is tried again
+        :param debug: print debug info
+        """
+        self.primary = urlsplit(url).netloc
+        self.session = session
+        self.evict_after = evict_after
+        self.slow_factor = slow_factor
+        self.cooldown = cooldown
+        self.debug = debug
+        self.lock = threading.Lock()
+        self.edges = {}
+        for host in [self.primary, *derive_edges(self.primary), *hosts]:
+            self.edges.setdefault(host, Edge(host))
+
+    def probe(self, url):
+        """Request url from every edge, and drop the ones that don't serve it."""
+        for edge in list(self.edges.values()):
+            if edge.host == self.primary:
+                continue
+            try:
+                start = time.time()
+                with self.session.get(self.url_on(url, edge.host), timeout=5) as r:
+                    r.raise_for_status()
+                    size = len(r.content)
+                self.success(edge.host, time.time() - start, size)
+            except Exception as e:
+                print(f'[WARN] edge {edge.host} is not usable: {e}')
+                del self.edges[edge.host]
+        self.debug and print(f'[DEBUG] edges: {", ".join(self.edges)}')
+
+    @staticmethod
+    def url_on(url, host):
+        return urlsplit(url)._replace(netloc=host).geturl()
+
+    def healthy(self):
+        now = time.time()
+        edges = [edge for edge in self.edges.values() if edge.evicted_until <= now]
+        # never run out of edges, the one from the playlist is always the last resort
+        return edges or [self.edges[self.primary]]
+
+    def pick(self, url):
+        """
+        Choose the edge for the next request of url (power of two choices: the cheaper of two random healthy edges).
+
+        :returns: (url on the chosen edge, host). Report the result with success() or failure().
+        """
+        with self.lock:
+            edges = self.healthy()
+            edge = min(random.sample(edges, min(2, len(edges))), key=Edge.cost)
+            edge.in_flight += 1
+        return self.url_on(url, edge.host), edge.host
+
+    def success(self, host, latency, size):
+        with self.lock:
+            edge = self.edges.get(host)
+            if edge is None:
+                return
+            edge.in_flight = max(edge.in_flight - 1, 0)
+            edge.failures = 0
+            edge.samples += 1
+            throughput = size / max(latency, 1e-6)
+            edge.latency = latency if edge.latency is None else 0.8 * edge.latency + 0.2 * latency
+            edge.throughput = throughput if edge.throughput is None else 0.8 * edge.throughput + 0.2 * throughput
+            measured = [e for e in self.healthy() if e.samples >= 5]
+            if edge.samples >= 5 and len(measured) > 1:
+                best = min(e.latency for e in measured)
+                if edge.latency > self.slow_factor * best:
+                    self._evict(edge, f'slow, {edge.latency * 1000:.0f} ms vs {best * 1000:.0f} ms')
+
+    def failure(self, host):
+        with self.lock:
+            edge = self.edges.get(host)
+            if edge is None:
+                return
+            edge.in_flight = max(edge.in_flight - 1, 0)
+            edge.failures += 1
+            if edge.failures >= self.evict_after:
+                self._evict(edge, f'{edge.failures} failures in a row')
+
+    def _evict(self, edge, reason):
+        if len(self.healthy()) <= 1:
+            return
+        edge.evicted_until = time.time() + self.cooldown
+        # start over when it's tried again
+        edge.latency = edge.throughput = None
+        edge.samples = edge.failures = 0
+        print(f'\n[WARN] evicted edge {edge.host} for {self.cooldown}s ({reason})')
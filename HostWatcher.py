@@ -0,0 +1,150 @@
+# Watch mode: detect Spaces going live across many hosts from one process, and download them as batch jobs.
+# One scheduler (a heap of next poll times) polls all hosts, with as many hosts per request as the API allows:
+# slowly while a host has nothing planned, and quickly around the scheduled start of an upcoming Space.
+import heapq
+import random
+import time
+
+from BatchRunner import BatchRunner
+from utils import retry_delay
+
+# max number of user IDs in one avatar_content request
+MAX_USERS_PER_REQUEST = 100
+
+
+class Host:
+    def __init__(self, handle, user):
+        self.handle = handle
+        self.user = user          # TwitterUser
+        self.next_poll = 0
+        self.pending = None       # (space ID, scheduled start in ms) of an upcoming Space
+
+
+class HostWatcher(BatchRunner):
+    def __init__(self, handles_file, interval=60, fast_interval=10, lead=300, **kwargs):
+        """
+        :param handles_file: text file with one @handle per line. It's read again every minute, so hosts can be added while running.
+        :param interval: seconds between polls of a host with nothing planned
+        :param fast_interval: seconds between polls of a host whose Space is about to start (or late)
+        :param lead: start polling fast this many seconds before the scheduled start
+        :param kwargs: BatchRunner options (jobs, threads, limit_rate, debug, ...) and TwitterSpace options for the downloads
+        """
+        # downloaded Space IDs are appended to <handles_file>.done, so they are skipped after a restart
+        super().__init__(handles_file, follow=True, **kwargs)
+        self.interval = interval
+        self.fast_interval = fast_interval
+        self.lead = lead
+        self.hosts = {}   # user ID -> Host
+        self.heap = []    # (next poll time, user ID); entries whose time doesn't match the host's next_poll are stale
+        self.handles = set()
+        self.failures = 0
+        self.api_client()
+
+    def read_queue(self):
+        """Resolve the handles added to the file since the last read."""
+        for line in self.queue_file.read_text(encoding='utf-8').splitlines():
+            handle = line.split('#')[0].strip().lstrip('@')
+            if not handle or handle.lower() in self.handles:
+                continue
+            self.handles.add(handle.lower())
+            try:
+                user = self.client.get_user(handle)
+            except Exception as e:
+                print(f"[Watch] failed to look up @{handle}: {e!r}")
+                self.handles.discard(handle.lower()) # try again on the next read
+                continue
+            host = self.hosts.setdefault(str(user.id), Host(handle, user))
+            self.schedule(host, time.time())
+            self.debug and print(f'[DEBUG] watching @{user.screen_name} ({user.id})')
+        return []
+
+    def schedule(self, host, when):
+        host.next_poll = when
+        heapq.heappush(self.heap, (when, str(host.user.id)))
+
+    def next_interval(self, host):
+        """Seconds until the host should be polled again."""
+        if host.pending is None:
+            # a little jitter, so hosts added at different times don't drift into separate requests forever
+            return self.interval * random.uniform(0.9, 1)
+        time_to_start = host.pending[1] / 1000 - time.time()
+        if time_to_start <= self.lead:
+            return self.fast_interval
+        # sleep until the fast polling should begin
+        return min(time_to_start - self.lead, self.interval * 10)
+
+    def due_hosts(self, now):
+        """Pop the hosts due for a poll, plus the ones due soon while there is room in the request."""
+        due = []
+        while self.heap and len(due) < MAX_USERS_PER_REQUEST:
+            when, user_id = self.heap[0]
+            host = self.hosts[user_id]
+            if when != host.next_poll:
+                heapq.heappop(self.heap)
+                continue
+            # hosts due within the next fast interval ride along, instead of needing a request of their own
+            if when > now + (self.fast_interval if due else 0):
+                break
+            heapq.heappop(self.heap)
+            due.append(host)
+        return due
+
+    def check_space(self, host, space_id):
+        """Look up the state of a Space found for host, and start downloading it if it's running."""
+        if space_id in self.seen:
+            host.pending = None
+            return
+        try:
+            self.client.type = 'space'
+            self.client.update_metadata(space_id)
+        except (Exception, SystemExit) as e:
+            print(f"[Watch] failed to get the metadata of {space_id} (@{host.handle}): {e!r}")
+            return
+        state = self.client.state
+        if state == 'NotStarted':
+            if host.pending is None or host.pending[0] != space_id:
+                print(f"[Watch] @{host.handle} scheduled {space_id} ({self.client.title})")
+            host.pending = (space_id, self.client.started_at or time.time() * 1000)
+            return
+        host.pending = None
+        self.seen.add(space_id)
+        if state == 'Running':
+            print(f"[Watch] @{host.handle} is live: {space_id} ({self.client.title})")
+            self.pending.put(space_id)
+
+    def poll(self, hosts):
+        try:
+            spaces = self.client.get_live_spaces([host.user.id for host in hosts])
+            self.failures = 0
+        except Exception as e:
+            self.failures += 1
+            delay = retry_delay(self.failures, base=self.fast_interval, cap=self.interval * 5)
+            print(f"[Watch] failed to poll {len(hosts)} hosts: {e!r}, retry in {delay:.0f}s")
+            for host in hosts:
+                self.schedule(host, time.time() + delay)
+            return
+        self.debug and print(f'[DEBUG] polled {len(hosts)} hosts, {len(spaces)} with a Space')
+        for host in hosts:
+            space = spaces.get(str(host.user.id))
+            if space is not None:
+                self.check_space(host, space['broadcast_id'])
+            elif host.pending is not None:
+                # scheduled Spaces don't always show on the avatar until they start
+                self.check_space(host, host.pending[0])
+            self.schedule(host, time.time() + self.next_interval(host))
+
+    def run(self):
+        self.start_workers()
+        last_read = 0
+        print(f"[Watch] Watching the hosts in {self.queue_file}")
+        try:
+            while True:
+                if time.time() - last_read > 60:
+                    self.read_queue()
+                    last_read = time.time()
+                if hosts := self.due_hosts(time.time()):
+                    self.poll(hosts)
+                wait = self.heap[0][0] - time.time() if self.heap else 60
+                time.sleep(max(0.5, min(wait, 60 - (time.time() - last_read))))
+        except KeyboardInterrupt:
+            print("\n[Watch] Stopped by user.")
@@ -0,0 +1,137 @@
+# Timings and counters of a download run, exported as JSON and/or a Prometheus textfile at the end.
+# Stages that run in parallel threads (e.g. decrypt, merge) are summed over all threads,
+# so they can add up to more than the wall time of the download stage.
+import contextlib
+import json
+import os
+import threading
+import time
+from pathlib import Path
+from urllib.parse import urlsplit
+
+# upper bounds (seconds) of the latency histogram buckets
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, float('inf'))
+
+
+class Metrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.start_time = time.time()
+        self.stages = {}      # stage -> [seconds, count]
+        self.counters = {}    # (name, labels) -> value
+        self.histograms = {}  # (name, labels) -> [bucket counts, sum, count]
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted(labels.items()))
+
+    def add_time(self, stage, seconds):
+        with self.lock:
+            total = self.stages.setdefault(stage, [0.0, 0])
+            total[0] += seconds
+            total[1] += 1
+
+    @contextlib.contextmanager
+    def stage(self, stage):
+        """Time the block as one run of the stage."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(stage, time.perf_counter() - start)
+
+    def inc(self, name, value=1, **labels):
+        key = self._key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = self._key(name, labels)
+        with self.lock:
+            buckets, _, _ = histogram = self.histograms.setdefault(key, [[0] * len(LATENCY_BUCKETS), 0.0, 0])
+            for i, bound in enumerate(LATENCY_BUCKETS):
+                if value <= bound:
+                    buckets[i] += 1
+                    break
+            histogram[1] += value
+            histogram[2] += 1
+
+    def record_segment(self, url, latency, size, decrypt_seconds=None):
+        """Record a downloaded chunk, labelled by the CDN host (edge) it came from."""
+        host = urlsplit(url).netloc
+        self.observe('segment_latency_seconds', latency, host=host)
+        self.inc('segments', host=host)
+        self.inc('bytes', size, host=host)
+        if decrypt_seconds is not None:
+            self.add_time('decrypt', decrypt_seconds)
+
+    def summary(self):
+        """:returns: a JSON-serializable dict of everything recorded so far"""
+        with self.lock:
+            stages = {stage: {'seconds': round(seconds, 6), 'count': count} for stage, (seconds, count) in self.stages.items()}
+            counters = [{'name': name, 'labels': dict(labels), 'value': value} for (name, labels), value in self.counters.items()]
+            histograms = []
+            for (name, labels), (buckets, total, count) in self.histograms.items():
+                histograms.append({'name': name, 'labels': dict(labels), 'buckets': dict(zip(map(str, LATENCY_BUCKETS), buckets)),
+                                   'sum': round(total, 6), 'count': count})
+        download = stages.get('download', {}).get('seconds')
+        downloaded = sum(c['value'] for c in counters if c['name'] == 'bytes')
+        return {
+            'wall_seconds': round(time.time() - self.start_time, 6),
+            'stages': stages,
+            'throughput_bytes_per_second': round(downloaded / download, 1) if download else None,
+            'counters': counters,
+            'histograms': histograms,
+        }
+
+    @staticmethod
+    def _write(path, text):
+        # write atomically, so a collector never reads a half written file
+        path = Path(path)
+        temp = path.with_name(path.name + '.tmp')
+        temp.write_text(text, encoding='utf-8')
+        os.replace(temp, path)
+
+    def write_json(self, path):
+        self._write(path, json.dumps(self.summary(), indent=2))
+
+    def write_prometheus(self, path):
+        """Write the metrics in the Prometheus text format, e.g. for the node_exporter textfile collector."""
+        summary = self.summary()
+
+        def labels(**kwargs):
+            if not kwargs:
+                return ''
+            escaped = {k: str(v).replace('\\', '\\\\').replace('"', '\\"') for k, v in kwargs.items()}
+            return '{' + ','.join(f'{k}="{v}"' for k, v in escaped.items()) + '}'
+
+        lines = [
+            '# HELP tslazer_wall_seconds Wall time of the run.',
+            '# TYPE tslazer_wall_seconds gauge',
+            f'tslazer_wall_seconds {summary["wall_seconds"]}',
+            '# HELP tslazer_stage_seconds_total Time spent in each stage (summed over threads).',
+            '# TYPE tslazer_stage_seconds_total counter',
+        ]
+        lines += [f'tslazer_stage_seconds_total{labels(stage=stage)} {s["seconds"]}' for stage, s in summary['stages'].items()]
+        lines += ['# HELP tslazer_stage_runs_total Number of times each stage ran.', '# TYPE tslazer_stage_runs_total counter']
+        lines += [f'tslazer_stage_runs_total{labels(stage=stage)} {s["count"]}' for stage, s in summary['stages'].items()]
+        if summary['throughput_bytes_per_second'] is not None:
+            lines += ['# HELP tslazer_throughput_bytes_per_second Bytes downloaded per second of the download stage.',
+                      '# TYPE tslazer_throughput_bytes_per_second gauge',
+                      f'tslazer_throughput_bytes_per_second {summary["throughput_bytes_per_second"]}']
+        for name in sorted({c['name'] for c in summary['counters']}):
+            lines.append(f'# TYPE tslazer_{name}_total counter')
+            lines += [f'tslazer_{name}_total{labels(**c["labels"])} {c["value"]}' for c in summary['counters'] if c['name'] == name]
+        for name in sorted({h['name'] for h in summary['histograms']}):
+            lines.append(f'# TYPE tslazer_{name} histogram')
+            for h in summary['histograms']:
+                if h['name'] != name:
+                    continue
+                cumulative = 0
+                for bound, count in zip(LATENCY_BUCKETS, h['buckets'].values()):
+                    cumulative += count
+                    le = '+Inf' if bound == float('inf') else bound
+                    lines.append(f'tslazer_{name}_bucket{labels(**h["labels"], le=le)} {cumulative}')
+                lines.append(f'tslazer_{name}_sum{labels(**h["labels"])} {h["sum"]}')
+                lines.append(f'tslazer_{name}_count{labels(**h["labels"])} {h["count"]}')
+        self._write(path, '\n'.join(lines) + '\n')
@@ -0,0 +1,139 @@
+# Incremental parser for live (sliding window) HLS playlists that are polled repeatedly.
+# Only the chunks past the last seen media sequence are parsed into Segment records, and
+# conditional requests (ETag / Last-Modified) skip playlists that haven't changed since the last poll.
+from dataclasses import dataclass
+from datetime import datetime
+from urllib.parse import urljoin
+
+
+@dataclass(frozen=True)
+class Key:
+    method: str
+    uri: str
+    iv: str # hex string starting with 0x, like in the playlist
+    absolute_uri: str
+
+
+@dataclass(frozen=True)
+class Segment:
+    """A chunk in the playlist. Has the same attributes as the m3u8 segments used elsewhere (absolute_uri, duration, key, ...)."""
+    sequence: int
+    uri: str
+    absolute_uri: str
+    duration: float
+    program_date_time: datetime = None
+    key: Key = None
+
+
+def parse_attributes(value):
+    """'METHOD=AES-128,URI="a,b",IV=0x..' -> {'METHOD': 'AES-128', 'URI': 'a,b', 'IV': '0x..'}"""
+    attributes = {}
+    while value:
+        name, _, value = value.partition('=')
+        if value.startswith('"'):
+            attribute, _, value = value[1:].partition('"')
+            value = value[1:] # the comma
+        else:
+            attribute, _, value = value.partition(',')
+        attributes[name.strip()] = attribute
+    return attributes
+
+
+class PlaylistWatcher:
+    def __init__(self, session, url, base_uri=None):
+        """
+        :param session: requests session
+        :param url: playlist url to poll. If it's a master playlist, its last variant is followed.
+        :param base_uri: url to resolve the chunks against (default: url)
+        """
+        self.session = session
+        self.url = url
+        self.base_uri = base_uri or url
+        self.etag = None
+        self.last_modified = None
+        self.last_sequence = None # media sequence of the last chunk returned
+        self.target_duration = None
+        self.endlist = False
+        self.missed = None # (first, last) media sequence of the chunks that left the window before we saw them, set by poll()
+        self.key = None    # EXT-X-KEY in effect at the end of the playlist
+
+    def poll(self):
+        """
+        Fetch the playlist, and parse the chunks that are new since the last poll.
+
+        :returns: list of new Segments (empty if the playlist didn't change)
+        """
+        headers = {}
+        if self.etag:
+            headers['If-None-Match'] = self.etag
+        if self.last_modified:
+            headers['If-Modified-Since'] = self.last_modified
+        r = self.session.get(self.url, headers=headers, timeout=10)
+        if r.status_code == 304:
+            self.missed = None
+            return []
+        r.raise_for_status()
+        self.etag = r.headers.get('ETag')
+        self.last_modified = r.headers.get('Last-Modified')
+        return self.parse(r.text)
+
+    def parse(self, text):
+        """:returns: list of new Segments in the playlist text"""
+        self.missed = None
+        lines = text.splitlines()
+        if any(line.startswith('#EXT-X-STREAM-INF') for line in lines):
+            # master playlist: follow the last variant (the one get_chunks uses as well), and parse that instead
+            variants = [line.strip() for line in lines if line.strip() and not line.startswith('#')]
+            self.url = urljoin(self.url, variants[-1])
+            self.etag = self.last_modified = None
+            return self.poll()
+
+        sequence = 0
+        new = []
+        duration = None
+        program_date_time = None
+        key = None
+        first = None
+        for line in lines:
+            line = line.strip()
+            if not line:
+                continue
+            if not line.startswith('#'):
+                # a chunk uri; only build records for the ones we haven't seen
+                if first is None:
+                    first = sequence
+                    if self.last_sequence is not None and first > self.last_sequence + 1:
+                        self.missed = (self.last_sequence + 1, first - 1)
+                if self.last_sequence is None or sequence > self.last_sequence:
+                    chunk_key = key
+                    if key and key.iv is None:
+                        # no IV in the tag means the media sequence number is the IV
+                        chunk_key = Key(key.method, key.uri, '0x' + sequence.to_bytes(16, 'big').hex(), key.absolute_uri)
+                    new.append(Segment(sequence, line, urljoin(self.base_uri, line), duration or 0.0, program_date_time, chunk_key))
+                sequence += 1
+                duration = program_date_time = None
+                continue
+            tag, _, value = line.partition(':')
+            seen = self.last_sequence is not None and sequence <= self.last_sequence # tags of a chunk we already have
+            if tag == '#EXTINF':
+                if not seen:
+                    duration = float(value.split(',')[0])
+            elif tag == '#EXT-X-MEDIA-SEQUENCE':
+                sequence = int(value)
+            elif tag == '#EXT-X-PROGRAM-DATE-TIME' and not seen:
+                program_date_time = datetime.fromisoformat(value.replace('Z', '+00:00'))
+            elif tag == '#EXT-X-KEY':
+                # key tags apply to all the chunks after them, so they're tracked even for chunks that are skipped
+                attributes = parse_attributes(value)
+                if attributes.get('METHOD', 'NONE') == 'NONE':
+                    key = None
+                else:
+                    key = Key(attributes['METHOD'], attributes.get('URI'), attributes.get('IV'), urljoin(self.base_uri, attributes.get('URI', '')))
+            elif tag == '#EXT-X-TARGETDURATION':
+                self.target_duration = float(value)
+            elif tag == '#EXT-X-ENDLIST':
+                self.endlist = True
+        self.key = key
+        if new:
+            self.last_sequence = new[-1].sequence
+        return new
@@ -0,0 +1,109 @@
+# On-disk cache of downloaded chunks, shared between runs and batch jobs (and processes), used with --segment-cache.
+# Chunks are looked up by their normalized URL: the path on the non-transcode stream, without the edge host, the
+# per-session hash in /Transcoding/v1/hls/{hash}/ and the query. So a --dyn_url run and a Space ID run of the same
+# stream hit the same entries. The content is stored once per sha256 (decrypted), and checked again when it's read.
+# When the blobs exceed max_size, the least recently used ones are evicted.
+import os
+import re
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from urllib.parse import urlsplit
+
+from utils import SegmentBuffer
+
+
+def normalize_url(url):
+    """https://{edge}/Transcoding/v1/hls/{hash}/transcode/{region}/{deploy}/{settings}/chunk_...aac?type=replay -> non_transcode/{region}/{deploy}/chunk_...aac"""
+    path = urlsplit(url).path
+    path = re.sub(r'^/Transcoding/v1/hls/[^/]+/', '', path)
+    # same replacement as for the playlist url, chunks on /transcode/ are the originals joined there
+    return re.sub(r'(^|/)transcode/([^/]+/[^/]+/)[^/]+/', r'\1non_transcode/\2', path)
+
+
+class SegmentCache:
+    def __init__(self, cache_dir=None, max_size=10 * 1024 ** 3, debug=False):
+        """
+        :param cache_dir: directory of the cache (default: ~/.cache/tslazer/segments)
+        :param max_size: max total size of the cached chunks in bytes
+        :param debug: print debug info
+        """
+        self.cache_dir = Path(cache_dir) if cache_dir else Path.home() / '.cache' / 'tslazer' / 'segments'
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.max_size = max_size
+        self.debug = debug
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(self.cache_dir / 'index.sqlite', timeout=10, check_same_thread=False)
+        with self.lock, self.db:
+            self.db.execute('CREATE TABLE IF NOT EXISTS urls (url TEXT PRIMARY KEY, sha256 TEXT)')
+            self.db.execute('CREATE TABLE IF NOT EXISTS blobs (sha256 TEXT PRIMARY KEY, size INTEGER, accessed REAL)')
+            self.db.execute('CREATE INDEX IF NOT EXISTS blobs_accessed ON blobs (accessed)')
+
+    def blob(self, sha256):
+        return self.cache_dir / sha256[:2] / sha256
+
+    def get(self, url):
+        """
+        :returns: a SegmentBuffer with the cached chunk, or None if it's not cached (or the cached copy is damaged)
+        """
+        key = normalize_url(url)
+        with self.lock, self.db:
+            row = self.db.execute('SELECT sha256 FROM urls WHERE url = ?', (key,)).fetchone()
+            if row is None:
+                return None
+            self.db.execute('UPDATE blobs SET accessed = ? WHERE sha256 = ?', (time.time(), row[0]))
+        buffer = SegmentBuffer()
+        try:
+            with self.blob(row[0]).open('rb') as f:
+                while data := f.read(SegmentBuffer.block_size):
+                    buffer.write(data)
+        except OSError:
+            buffer.close()
+            self._forget(row[0])
+            return None
+        if buffer.hexdigest != row[0]:
+            print(f'[WARN] cached copy of {key} is damaged, downloading it again.')
+            buffer.close()
+            self._forget(row[0])
+            return None
+        return buffer
+
+    def put(self, url, buffer):
+        """Add a downloaded chunk (a SegmentBuffer, which is left open)."""
+        key = normalize_url(url)
+        sha256 = buffer.hexdigest
+        f = self.blob(sha256)
+        if not f.exists():
+            f.parent.mkdir(exist_ok=True)
+            # write to a temp file first, so other processes never read a partial blob
+            temp = f.with_name(f'{sha256}.{os.getpid()}.{threading.get_ident()}.part')
+            buffer.save(temp)
+            os.replace(temp, f)
+        now = time.time()
+        with self.lock, self.db:
+            self.db.execute('INSERT OR REPLACE INTO blobs VALUES (?, ?, ?)', (sha256, buffer.size, now))
+            self.db.execute('INSERT OR REPLACE INTO urls VALUES (?, ?)', (key, sha256))
+            total = self.db.execute('SELECT SUM(size) FROM blobs').fetchone()[0] or 0
+            if total > self.max_size:
+                self._evict(total)
+
+    def _evict(self, total):
+        # must hold the lock
+        evicted = 0
+        for sha256, size in self.db.execute('SELECT sha256, size FROM blobs ORDER BY accessed').fetchall():
+            if total <= self.max_size:
+                break
+            self.db.execute('DELETE FROM blobs WHERE sha256 = ?', (sha256,))
+            self.db.execute('DELETE FROM urls WHERE sha256 = ?', (sha256,))
+            self.blob(sha256).unlink(missing_ok=True)
+            total -= size
+            evicted += 1
+        self.debug and print(f'\n[DEBUG] evicted {evicted} chunks from the segment cache')
+
+    def _forget(self, sha256):
+        """Drop a missing or damaged blob, and all the urls pointing to it."""
+        with self.lock, self.db:
+            self.db.execute('DELETE FROM blobs WHERE sha256 = ?', (sha256,))
+            self.db.execute('DELETE FROM urls WHERE sha256 = ?', (sha256,))
+        self.blob(sha256).unlink(missing_ok=True)
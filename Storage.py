@@ -0,0 +1,195 @@
+# Where the finished recordings go: a local directory (default), or an S3-compatible bucket with --storage s3://bucket/prefix.
+# Uploads are streamed: the output is cut into parts as it's written, and the parts are uploaded in parallel while
+# the download goes on. Only a few parts are held in memory, instead of the whole recording on the local disk.
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from shutil import copyfileobj
+from urllib.parse import urlsplit
+
+# S3 needs parts of at least 5 MB (except the last one), and allows at most 10000 parts
+MIN_PART_SIZE = 5 * 1024 * 1024
+MAX_PARTS = 10000
+
+
+def open_storage(url=None, path='.', **kwargs):
+    """
+    :param url: s3://bucket/prefix, or None for the local directory path
+    :param path: local directory
+    :param kwargs: S3Storage options
+    """
+    if url is None:
+        return LocalStorage(path)
+    if not url.startswith('s3://'):
+        raise ValueError(f'unsupported storage {url}, only s3://bucket/prefix is supported')
+    return S3Storage(url, **kwargs)
+
+
+class LocalStorage:
+    remote = False
+
+    def __init__(self, path='.'):
+        self.path = Path(path)
+
+    def open(self, name):
+        """:returns: a binary file object to write name to"""
+        self.path.mkdir(parents=True, exist_ok=True)
+        return (self.path / name).open('wb')
+
+    def location(self, name):
+        return str(self.path / name)
+
+    def upload(self, f, name):
+        """Store the local file f as name. :returns: the location"""
+        f = Path(f)
+        target = self.path / name
+        if f.resolve() != target.resolve():
+            f.replace(target)
+        return str(target)
+
+
+class S3Storage:
+    remote = True
+
+    def __init__(self, url, endpoint_url=None, part_size=8 * 1024 * 1024, workers=4, debug=False):
+        """
+        :param url: s3://bucket/prefix
+        :param endpoint_url: endpoint of an S3-compatible service (e.g. MinIO). Credentials are read the usual boto3 way (env, ~/.aws)
+        :param part_size: size of the parts of multipart uploads
+        :param workers: number of parts uploaded at the same time (per file)
+        :param debug: print debug info
+        """
+        try:
+            import boto3
+        except ImportError:
+            raise ImportError("--storage s3:// requires boto3. Install it with: pip install boto3") from None
+        parts = urlsplit(url)
+        self.bucket = parts.netloc
+        self.prefix = parts.path.strip('/')
+        self.part_size = max(part_size, MIN_PART_SIZE)
+        self.workers = workers
+        self.debug = debug
+        # the client is thread-safe, so it's shared by all the uploads (and jobs in batch mode)
+        self.client = boto3.client('s3', endpoint_url=endpoint_url)
+
+    def key(self, name):
+        return f'{self.prefix}/{name}' if self.prefix else name
+
+    def location(self, name):
+        return f's3://{self.bucket}/{self.key(name)}'
+
+    def open(self, name):
+        """:returns: a MultipartUpload to write name to. close() finishes the upload, abort() cancels it."""
+        return MultipartUpload(self.client, self.bucket, self.key(name), self.part_size, self.workers, self.debug)
+
+    def upload(self, f, name):
+        """Upload the local file f as name, and delete it. :returns: the location"""
+        with Path(f).open('rb') as fi, self.open(name) as upload:
+            copyfileobj(fi, upload, 1024 * 1024)
+        Path(f).unlink()
+        return self.location(name)
+
+
+class MultipartUpload:
+    """
+    Write-only file object that uploads what's written to it as a multipart upload, parts uploading in parallel.
+
+    write() blocks while `workers` parts are in flight, so the memory used is bounded by (workers + 1) * part_size.
+    Output smaller than one part is uploaded with a single PutObject when it's closed.
+    """
+    def __init__(self, client, bucket, key, part_size, workers=4, debug=False):
+        self.client = client
+        self.bucket = bucket
+        self.key = key
+        self.part_size = part_size
+        self.debug = debug
+        self.buffer = bytearray()
+        self.upload_id = None
+        self.parts = {}   # part number -> ETag
+        self.futures = []
+        self.error = None
+        self.size = 0
+        self.closed = False
+        self.slots = threading.BoundedSemaphore(workers)
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def write(self, data):
+        if self.error:
+            raise self.error
+        self.buffer += data
+        self.size += len(data)
+        while len(self.buffer) >= self.part_size:
+            self._submit(bytes(self.buffer[:self.part_size]))
+            del self.buffer[:self.part_size]
+        return len(data)
+
+    def flush(self):
+        # only whole parts can be uploaded, the rest is kept until there is enough (or the upload is closed)
+        pass
+
+    def _submit(self, data):
+        if self.upload_id is None:
+            self.upload_id = self.client.create_multipart_upload(Bucket=self.bucket, Key=self.key)['UploadId']
+            self.debug and print(f'[DEBUG] started multipart upload of s3://{self.bucket}/{self.key}')
+        number = len(self.futures) + 1
+        if number > MAX_PARTS:
+            raise ValueError(f'more than {MAX_PARTS} parts, use a bigger part size')
+        self.slots.acquire()
+        self.futures.append(self.executor.submit(self._upload_part, number, data))
+
+    def _upload_part(self, number, data):
+        try:
+            r = self.client.upload_part(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id, PartNumber=number, Body=data)
+            self.parts[number] = r['ETag']
+            self.debug and print(f'\n[DEBUG] uploaded part {number} ({len(data)} bytes) of {self.key}')
+        except Exception as e:
+            self.error = e
+            raise
+        finally:
+            self.slots.release()
+
+    def close(self):
+        """Upload the rest and finish the upload."""
+        if self.closed:
+            return
+        if self.upload_id is None:
+            # smaller than one part
+            self.client.put_object(Bucket=self.bucket, Key=self.key, Body=bytes(self.buffer))
+        else:
+            if self.buffer:
+                self._submit(bytes(self.buffer))
+            for future in self.futures:
+                future.exception() # wait
+            if self.error:
+                self.abort()
+                raise self.error
+            self.client.complete_multipart_upload(
+                Bucket=self.bucket, Key=self.key, UploadId=self.upload_id,
+                MultipartUpload={'Parts': [{'PartNumber': n, 'ETag': self.parts[n]} for n in sorted(self.parts)]})
+        self.buffer = bytearray()
+        self.closed = True
+        self.executor.shutdown()
+        self.debug and print(f'[DEBUG] uploaded s3://{self.bucket}/{self.key} ({self.size} bytes, {len(self.futures) or 1} parts)')
+
+    def abort(self):
+        """Cancel the upload, so the parts uploaded so far don't linger (and cost) in the bucket."""
+        if self.closed:
+            return
+        self.closed = True
+        for future in self.futures:
+            future.cancel()
+        self.executor.shutdown()
+        if self.upload_id is not None:
+            try:
+                self.client.abort_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id)
+            except Exception as e:
+                print(f'[WARN] failed to abort the upload of {self.key}: {e!r}')
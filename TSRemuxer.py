@@ -0,0 +1,492 @@
+# In-process remux of the MPEG-TS of broadcasts (H.264 + AAC) into a fragmented MP4, used with --mp4.
+# TS data is fed in as the chunks are written, and the MP4 is written in a single pass: the moov first
+# (with the codec setup from the first SPS/PPS and ADTS header), then one moof+mdat fragment per ~2 seconds
+# starting at a keyframe, and an mfra index at the end for seeking. Only the current fragment is kept in memory.
+#
+# Twitter's TS quirks handled here: PAT/PMT not at the start of every chunk, an extra timed ID3 metadata stream,
+# timestamps that jump (or go back) between chunks, ADTS frames split over PES packets, and frames before the first keyframe.
+import struct
+from pathlib import Path
+
+from Validator import ADTS_SAMPLE_RATES, TS_PACKET
+
+PTS_WRAP = 1 << 33
+VIDEO_TIMESCALE = 90000
+MAX_STEP = 10 * VIDEO_TIMESCALE # a larger (or negative) timestamp step is a discontinuity
+STREAM_TYPES = {0x1B: 'video', 0x0F: 'audio'} # H.264, ADTS AAC
+KEYFRAME_FLAGS = 0x02000000     # sample_depends_on=2 (depends on no other sample)
+NON_KEYFRAME_FLAGS = 0x01010000 # sample_depends_on=1, sample_is_non_sync_sample=1
+MATRIX = struct.pack('>9I', 0x10000, 0, 0, 0, 0x10000, 0, 0, 0, 0x40000000)
+
+
+def box(kind, *payloads):
+    data = b''.join(payloads)
+    return struct.pack('>I4s', 8 + len(data), kind.encode()) + data
+
+
+def full_box(kind, version, flags, *payloads):
+    return box(kind, struct.pack('>I', (version << 24) | flags), *payloads)
+
+
+def descriptor(tag, *payloads):
+    data = b''.join(payloads)
+    return bytes([tag, len(data)]) + data
+
+
+class BitReader:
+    """Reads the exp-Golomb coded fields of an SPS."""
+    def __init__(self, data):
+        # remove emulation prevention bytes
+        data = data.replace(b'\x00\x00\x03', b'\x00\x00')
+        self.value = int.from_bytes(data, 'big')
+        self.size = len(data) * 8
+        self.pos = 0
+
+    def bits(self, n):
+        self.pos += n
+        return (self.value >> (self.size - self.pos)) & ((1 << n) - 1)
+
+    def ue(self):
+        zeros = 0
+        while self.bits(1) == 0:
+            zeros += 1
+        return (1 << zeros) - 1 + self.bits(zeros)
+
+    def se(self):
+        v = self.ue()
+        return (v + 1) // 2 if v % 2 else -(v // 2)
+
+
+def sps_dimensions(sps):
+    """:returns: (width, height) of an H.264 SPS NAL unit"""
+    r = BitReader(sps[1:])
+    profile = r.bits(8)
+    r.bits(16) # constraint flags, level
+    r.ue() # sps id
+    chroma_format = 1
+    if profile in (100, 110, 122, 244, 44, 83, 86, 118, 128, 138, 139, 134, 135):
+        chroma_format = r.ue()
+        if chroma_format == 3:
+            r.bits(1)
+        r.ue(), r.ue() # bit depths
+        r.bits(1)
+        if r.bits(1): # scaling matrices
+            for i in range(8 if chroma_format != 3 else 12):
+                if r.bits(1):
+                    last = next_ = 8
+                    for _ in range(16 if i < 6 else 64):
+                        if next_:
+                            next_ = (last + r.se()) % 256
+                        last = next_ or last
+    r.ue() # log2_max_frame_num
+    poc_type = r.ue()
+    if poc_type == 0:
+        r.ue()
+    elif poc_type == 1:
+        r.bits(1)
+        r.se(), r.se()
+        for _ in range(r.ue()):
+            r.se()
+    r.ue() # max_num_ref_frames
+    r.bits(1)
+    width_mbs = r.ue() + 1
+    height_units = r.ue() + 1
+    frame_mbs_only = r.bits(1)
+    if not frame_mbs_only:
+        r.bits(1)
+    r.bits(1)
+    width = width_mbs * 16
+    height = (2 - frame_mbs_only) * height_units * 16
+    if r.bits(1): # cropping
+        left, right, top, bottom = r.ue(), r.ue(), r.ue(), r.ue()
+        crop_x = 2 if chroma_format in (1, 2) else 1
+        crop_y = (2 if chroma_format == 1 else 1) * (2 - frame_mbs_only)
+        width -= crop_x * (left + right)
+        height -= crop_y * (top + bottom)
+    return width, height
+
+
+def split_nal_units(data):
+    """Split an Annex B byte stream into NAL units (without start codes)."""
+    units = []
+    start = data.find(b'\x00\x00\x01')
+    while start != -1:
+        start += 3
+        end = data.find(b'\x00\x00\x01', start)
+        unit = data[start:end if end != -1 else len(data)]
+        # a 4-byte start code leaves a zero at the end of the previous unit
+        units.append(unit.rstrip(b'\x00') if end != -1 else unit)
+        start = end
+    return [unit for unit in units if unit]
+
+
+class Track:
+    def __init__(self, track_id, kind):
+        self.track_id = track_id
+        self.kind = kind
+        self.timescale = VIDEO_TIMESCALE
+        self.config = None      # sample entry box, once the codec setup is known
+        self.width = self.height = 0
+        self.samples = []       # (duration, size, flags, composition offset) of the current fragment, in trun entry order
+        self.data = []          # sample data of the current fragment
+        self.base_time = None   # decode time of the first sample of the current fragment
+        self.next_time = None   # decode time of the next sample
+        self.random_access = [] # (time, moof offset, traf number) of each fragment, for the mfra
+
+    @property
+    def buffered(self):
+        """Seconds of samples in the current fragment."""
+        return sum(s[0] for s in self.samples) / self.timescale
+
+    def add(self, data, duration, flags=KEYFRAME_FLAGS, composition_offset=0):
+        if self.base_time is None:
+            self.base_time = self.next_time
+        self.samples.append((duration, len(data), flags, composition_offset))
+        self.data.append(data)
+        self.next_time += duration
+
+
+class TSRemuxer:
+    def __init__(self, output, duration=None, fragment_seconds=2.0, debug=False):
+        """
+        :param output: the mp4 file to write, or a writable file object (it's written sequentially, and closed by close())
+        :param duration: expected duration in seconds (e.g. the sum of EXTINF), written to the header so players know it upfront
+        :param fragment_seconds: min duration of a fragment. Fragments start at keyframes, so they can be longer.
+        :param debug: print debug info
+        """
+        if hasattr(output, 'write'):
+            self.output = None
+            self.fp = output
+        else:
+            self.output = Path(output)
+            self.fp = self.output.open('wb')
+        self.duration = duration
+        self.fragment_seconds = fragment_seconds
+        self.debug = debug
+        self.offset = 0
+        self.partial = b''
+        self.pmt_pid = None
+        self.streams = {}       # PID -> 'video' or 'audio'
+        self.pes = {}           # PID -> [pts, dts, bytearray] of the PES packet being assembled
+        self.video = Track(1, 'video')
+        self.audio = Track(2, 'audio')
+        self.tracks = []        # the tracks in the moov, once it's written
+        self.origin = None      # raw timestamp of time 0
+        self.sps = self.pps = None
+        self.pending_video = None # the last access unit, written once the next one tells its duration
+        self.last_dts = None
+        self.last_duration = 3000
+        self.audio_buffer = bytearray()
+        self.audio_pts = None
+        self.sequence = 0
+        self.discontinuities = 0
+        self.lost_packets = 0
+
+    # TS demuxing
+
+    def write(self, data):
+        """Feed TS data, in order. Packets can be split anywhere."""
+        data = self.partial + data
+        pos = 0
+        while pos + TS_PACKET <= len(data):
+            if data[pos] != 0x47:
+                # lost sync (e.g. a broken chunk): skip to the next sync byte
+                self.lost_packets += 1
+                next_ = data.find(b'\x47', pos + 1)
+                pos = next_ if next_ != -1 else len(data)
+                continue
+            self.packet(data[pos:pos + TS_PACKET])
+            pos += TS_PACKET
+        self.partial = data[pos:]
+
+    def flush(self):
+        pass
+
+    def packet(self, p):
+        pid = ((p[1] & 0x1F) << 8) | p[2]
+        afc = (p[3] >> 4) & 3
+        if not afc & 1:
+            return
+        start = 4 + (p[4] + 1 if afc & 2 else 0)
+        if start >= TS_PACKET:
+            return
+        payload = p[start:]
+        unit_start = p[1] & 0x40
+        if pid == 0:
+            if unit_start:
+                self.parse_pat(payload)
+        elif pid == self.pmt_pid:
+            if unit_start:
+                self.parse_pmt(payload)
+        elif unit_start:
+            self.finish_pes(pid)
+            if payload[:3] != b'\x00\x00\x01' or len(payload) < 9:
+                return
+            if pid not in self.streams and self.pmt_pid is None:
+                # no PMT (yet), tell the stream type by the PES stream id
+                stream_id = payload[3]
+                if 0xE0 <= stream_id <= 0xEF:
+                    self.streams[pid] = 'video'
+                elif 0xC0 <= stream_id <= 0xDF:
+                    self.streams[pid] = 'audio'
+            if pid not in self.streams:
+                return
+            flags = payload[7]
+            pts = self.timestamp(payload[9:14]) if flags & 0x80 else None
+            dts = self.timestamp(payload[14:19]) if flags & 0xC0 == 0xC0 else pts
+            self.pes[pid] = [pts, dts, bytearray(payload[9 + payload[8]:])]
+        elif pid in self.pes:
+            self.pes[pid][2] += payload
+
+    @staticmethod
+    def timestamp(b):
+        return (((b[0] >> 1) & 7) << 30) | (b[1] << 22) | ((b[2] >> 1) << 15) | (b[3] << 7) | (b[4] >> 1)
+
+    def parse_pat(self, payload):
+        section = payload[1 + payload[0]:]
+        length = ((section[1] & 0xF) << 8) | section[2]
+        for i in range(8, min(3 + length - 4, len(section) - 3), 4):
+            program = (section[i] << 8) | section[i + 1]
+            if program != 0:
+                self.pmt_pid = ((section[i + 2] & 0x1F) << 8) | section[i + 3]
+                return
+
+    def parse_pmt(self, payload):
+        section = payload[1 + payload[0]:]
+        end = min(3 + (((section[1] & 0xF) << 8) | section[2]) - 4, len(section))
+        i = 12 + (((section[10] & 0xF) << 8) | section[11])
+        while i + 5 <= end:
+            stream_type = section[i]
+            pid = ((section[i + 1] & 0x1F) << 8) | section[i + 2]
+            # other streams (like Twitter's timed ID3 metadata) are dropped
+            if stream_type in STREAM_TYPES:
+                self.streams[pid] = STREAM_TYPES[stream_type]
+            i += 5 + (((section[i + 3] & 0xF) << 8) | section[i + 4])
+
+    def finish_pes(self, pid):
+        if pid not in self.pes:
+            return
+        pts, dts, data = self.pes.pop(pid)
+        if self.streams[pid] == 'video':
+            self.video_access_unit(pts, dts, bytes(data))
+        else:
+            self.audio_frames(pts, data)
+
+    # elementary streams
+
+    def relative(self, timestamp):
+        """Timestamp relative to the start of the stream, in 90kHz."""
+        if self.origin is None:
+            self.origin = timestamp
+        t = (timestamp - self.origin) % PTS_WRAP
+        # slightly before the origin (e.g. the first video DTS before the first audio PTS)
+        return 0 if t > PTS_WRAP // 2 else t
+
+    def video_access_unit(self, pts, dts, data):
+        if dts is None:
+            return
+        keyframe = False
+        sample = bytearray()
+        for unit in split_nal_units(data):
+            kind = unit[0] & 0x1F
+            if kind == 7:
+                if self.sps is None:
+                    self.sps = unit
+                    self.video.width, self.video.height = sps_dimensions(unit)
+                continue
+            if kind == 8:
+                self.pps = self.pps or unit
+                continue
+            if kind == 9: # access unit delimiter
+                continue
+            keyframe |= kind == 5
+            sample += struct.pack('>I', len(unit)) + unit
+        if not sample:
+            return
+        if self.last_dts is None:
+            if not keyframe:
+                # can't be decoded without the keyframe before it
+                return
+            self.video.next_time = self.relative(dts)
+        else:
+            step = (dts - self.last_dts) % PTS_WRAP
+            if step == 0 or step > MAX_STEP:
+                # timestamps jumped: continue the timeline as if the frames were contiguous
+                self.discontinuities += 1
+                self.debug and print(f'\n[DEBUG] video timestamp jump of {(dts - self.last_dts) / VIDEO_TIMESCALE:.3f}s')
+                step = self.last_duration
+            self.last_duration = step
+            self.add_video(*self.pending_video, step)
+        self.last_dts = dts
+        composition_offset = (pts - dts) % PTS_WRAP if pts is not None else 0
+        self.pending_video = (bytes(sample), keyframe, composition_offset if composition_offset < MAX_STEP else 0)
+
+    def add_video(self, sample, keyframe, composition_offset, duration):
+        if keyframe and self.video.buffered >= self.fragment_seconds:
+            self.write_fragment()
+        self.video.add(sample, duration, KEYFRAME_FLAGS if keyframe else NON_KEYFRAME_FLAGS, composition_offset)
+
+    def audio_frames(self, pts, data):
+        if self.audio_pts is None and pts is not None:
+            self.audio_pts = pts
+        self.audio_buffer += data
+        buffer = self.audio_buffer
+        pos = 0
+        while pos + 7 <= len(buffer):
+            if buffer[pos] != 0xFF or buffer[pos + 1] & 0xF6 != 0xF0:
+                pos += 1
+                continue
+            length = ((buffer[pos + 3] & 3) << 11) | (buffer[pos + 4] << 3) | (buffer[pos + 5] >> 5)
+            if length < 7:
+                pos += 1
+                continue
+            if pos + length > len(buffer):
+                # the rest of the frame is in the next PES packet
+                break
+            header = 7 if buffer[pos + 1] & 1 else 9
+            if self.audio.config is None:
+                self.audio_config(buffer[pos:pos + 7])
+            if self.audio.next_time is None:
+                self.audio.next_time = self.relative(self.audio_pts) * self.audio.timescale // VIDEO_TIMESCALE
+            self.audio.add(bytes(buffer[pos + header:pos + length]), ((buffer[pos + 6] & 3) + 1) * 1024)
+            # without video, audio decides when a fragment is written. A video stream that is declared but never
+            # shows up is given up on after a few fragments' worth of audio (see ready())
+            if (not self.video.config and self.audio.buffered >= self.fragment_seconds
+                    and (self.tracks == [self.audio] or 'video' not in self.streams.values()
+                         or self.audio.buffered >= 5 * self.fragment_seconds)):
+                self.write_fragment()
+            pos += length
+        del buffer[:pos]
+
+    def audio_config(self, header):
+        profile = (header[2] >> 6) & 3
+        rate_index = (header[2] >> 2) & 0xF
+        channels = ((header[2] & 1) << 2) | (header[3] >> 6)
+        self.audio.timescale = ADTS_SAMPLE_RATES[rate_index]
+        # AudioSpecificConfig
+        asc = struct.pack('>H', ((profile + 1) << 11) | (rate_index << 7) | (channels << 3))
+        esds = full_box('esds', 0, 0, descriptor(
+            3, struct.pack('>HB', self.audio.track_id, 0),
+            descriptor(4, struct.pack('>BB3sII', 0x40, 0x15, b'\0\0\0', 0, 0), descriptor(5, asc)),
+            descriptor(6, b'\x02')))
+        self.audio.config = box('mp4a', bytes(6), struct.pack('>H', 1), bytes(8),
+                                struct.pack('>HHHHI', channels, 16, 0, 0, self.audio.timescale << 16), esds)
+
+    def video_config(self):
+        avcc = box('avcC', bytes([1, self.sps[1], self.sps[2], self.sps[3], 0xFF, 0xE1]), struct.pack('>H', len(self.sps)), self.sps,
+                   b'\x01', struct.pack('>H', len(self.pps)), self.pps)
+        self.video.config = box('avc1', bytes(6), struct.pack('>H', 1), bytes(16),
+                                struct.pack('>HHIIIH', self.video.width, self.video.height, 0x480000, 0x480000, 0, 1),
+                                bytes(32), struct.pack('>Hh', 0x18, -1), avcc)
+
+    # MP4 writing
+
+    def emit(self, data):
+        self.fp.write(data)
+        self.offset += len(data)
+
+    def ready(self):
+        """Write the moov once the codec setup of every track is known. :returns: True if it's written"""
+        if self.tracks:
+            return True
+        kinds = set(self.streams.values())
+        if self.sps and self.pps and not self.video.config:
+            self.video_config()
+        # don't wait for a track that may never come for more than a few fragments
+        waited = max(self.video.buffered, self.audio.buffered) >= 5 * self.fragment_seconds
+        if ('video' in kinds and not self.video.config) or ('audio' in kinds and not self.audio.config):
+            if not waited:
+                return False
+        self.tracks = [track for track in (self.video, self.audio) if track.config]
+        if not self.tracks:
+            return False
+        for track in (self.video, self.audio):
+            if not track.config:
+                print(f'[WARN] no usable {track.kind} stream found, the mp4 will only have {self.tracks[0].kind}.')
+        self.emit(box('ftyp', b'isom', struct.pack('>I', 0x200), b'isomiso6avc1mp41'))
+        self.emit(self.moov())
+        return True
+
+    def moov(self):
+        traks = []
+        for track in self.tracks:
+            video = track.kind == 'video'
+            tkhd = full_box('tkhd', 0, 3, struct.pack('>IIIII', 0, 0, track.track_id, 0, 0), bytes(8),
+                            struct.pack('>hhhH', 0, 0, 0 if video else 0x100, 0), MATRIX,
+                            struct.pack('>II', track.width << 16, track.height << 16))
+            mdhd = full_box('mdhd', 0, 0, struct.pack('>IIIIHH', 0, 0, track.timescale, 0, 0x55C4, 0))
+            hdlr = full_box('hdlr', 0, 0, bytes(4), b'vide' if video else b'soun', bytes(12),
+                            b'VideoHandler\0' if video else b'SoundHandler\0')
+            header = full_box('vmhd', 0, 1, bytes(8)) if video else full_box('smhd', 0, 0, bytes(4))
+            dinf = box('dinf', full_box('dref', 0, 0, struct.pack('>I', 1), full_box('url ', 0, 1)))
+            stbl = box('stbl', full_box('stsd', 0, 0, struct.pack('>I', 1), track.config),
+                       full_box('stts', 0, 0, bytes(4)), full_box('stsc', 0, 0, bytes(4)),
+                       full_box('stsz', 0, 0, bytes(8)), full_box('stco', 0, 0, bytes(4)))
+            traks.append(box('trak', tkhd, box('mdia', mdhd, hdlr, box('minf', header, dinf, stbl))))
+        mvhd = full_box('mvhd', 0, 0, struct.pack('>IIIIIH', 0, 0, 1000, 0, 0x10000, 0x100), bytes(10), MATRIX, bytes(24),
+                        struct.pack('>I', len(self.tracks) + 1))
+        mvex = [full_box('mehd', 0, 0, struct.pack('>I', int(self.duration * 1000)))] if self.duration else []
+        mvex += [full_box('trex', 0, 0, struct.pack('>IIIII', track.track_id, 1, 0, 0, 0)) for track in self.tracks]
+        return box('moov', mvhd, *traks, box('mvex', *mvex))
+
+    def write_fragment(self):
+        if not self.ready():
+            return
+        tracks = [track for track in self.tracks if track.samples]
+        if not tracks:
+            return
+        self.sequence += 1
+
+        def moof(data_offsets):
+            trafs = []
+            for track, data_offset in zip(tracks, data_offsets):
+                video = track.kind == 'video'
+                flags = 0x001 | 0x100 | 0x200 | 0x400 | (0x800 if video else 0)
+                entries = b''.join(struct.pack('>IIIi' if video else '>III', *(s if video else s[:3])) for s in track.samples)
+                trafs.append(box('traf', full_box('tfhd', 0, 0x020000, struct.pack('>I', track.track_id)),
+                                 full_box('tfdt', 1, 0, struct.pack('>Q', track.base_time)),
+                                 full_box('trun', 1, flags, struct.pack('>Ii', len(track.samples), data_offset), entries)))
+            return box('moof', full_box('mfhd', 0, 0, struct.pack('>I', self.sequence)), *trafs)
+
+        size = len(moof([0] * len(tracks)))
+        data_offsets = []
+        position = size + 8 # after the moof and the mdat header
+        for track in tracks:
+            data_offsets.append(position)
+            position += sum(s[1] for s in track.samples)
+        moof_offset = self.offset
+        self.emit(moof(data_offsets))
+        self.emit(struct.pack('>I4s', position - size, b'mdat'))
+        for number, track in enumerate(tracks, 1):
+            track.random_access.append((track.base_time, moof_offset, number))
+            for data in track.data:
+                self.emit(data)
+            track.samples, track.data, track.base_time = [], [], None
+
+    def close(self):
+        """Write the rest of the samples and the index, and close the file."""
+        for pid in list(self.pes):
+            self.finish_pes(pid)
+        if self.pending_video:
+            self.add_video(*self.pending_video, self.last_duration)
+            self.pending_video = None
+        self.write_fragment()
+        if not self.tracks:
+            self.fp.close()
+            raise ValueError('no H.264 or AAC stream found')
+        tfras = []
+        for track in self.tracks:
+            entries = b''.join(struct.pack('>QQBBB', time, offset, traf, 1, 1) for time, offset, traf in track.random_access)
+            tfras.append(full_box('tfra', 1, 0, struct.pack('>III', track.track_id, 0, len(track.random_access)), entries))
+        size = 8 + sum(map(len, tfras)) + 16
+        self.emit(box('mfra', *tfras, full_box('mfro', 0, 0, struct.pack('>I', size))))
+        self.fp.close()
+        self.debug and print(f'[DEBUG] remuxed {self.sequence} fragments, {self.discontinuities} timestamp jumps, {self.lost_packets} packets out of sync')
+
+    def discard(self):
+        """Close and delete the unfinished mp4 (or abort the file object, if it can be)."""
+        if self.output is None:
+            hasattr(self.fp, 'abort') and self.fp.abort()
+            return
+        self.fp.close()
+        self.output.unlink(missing_ok=True)
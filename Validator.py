@@ -0,0 +1,275 @@
+# Frame-level check of merged ADTS audio and MPEG-TS video, chunk by chunk, without decoding anything.
+# ADTS: every chunk must be a chain of whole frames, and the frames' samples must add up to the chunk's EXTINF.
+# TS: every chunk must be whole 188-byte packets with sync bytes and unbroken continuity counters, and its PTS span must match EXTINF.
+# With NumPy installed, headers are parsed and ADTS frames chained with array operations; otherwise a (much slower for video) pure Python fallback does the same checks.
+#
+#   python Validator.py merged.aac --manifest .tslazer_<id>.json   # flag bad chunks by name (the manifest is kept with --keep)
+#   python Validator.py broadcast.ts                                # check the whole file as one chunk
+import argparse
+import hashlib
+import json
+import mmap
+import os
+import sys
+from pathlib import Path
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+ADTS_SAMPLE_RATES = (96000, 88200, 64000, 48000, 44100, 32000, 24000, 22050, 16000, 12000, 11025, 8000, 7350)
+TS_PACKET = 188
+PTS_CLOCK = 90000
+PTS_WRAP = 2 ** 33
+
+
+class ChunkReport:
+    def __init__(self, uri, offset, size, expected=None):
+        self.uri = uri
+        self.offset = offset       # in the merged file
+        self.size = size
+        self.expected = expected   # EXTINF duration
+        self.duration = None       # measured duration
+        self.errors = []
+
+    @property
+    def ok(self):
+        return not self.errors
+
+
+def check_adts(data):
+    """:returns: (duration in seconds, list of errors) of a chunk of ADTS frames"""
+    if np is not None and len(data) >= 7:
+        return check_adts_np(data)
+    errors = []
+    pos = 0
+    duration = 0.0
+    while pos < len(data):
+        if pos + 7 > len(data) or data[pos] != 0xFF or data[pos + 1] & 0xF6 != 0xF0:
+            errors.append(f'no ADTS frame at byte {pos}')
+            break
+        length = ((data[pos + 3] & 3) << 11) | (data[pos + 4] << 3) | (data[pos + 5] >> 5)
+        rate = (data[pos + 2] >> 2) & 0xF
+        if length < 7 or rate >= len(ADTS_SAMPLE_RATES):
+            errors.append(f'bad ADTS header at byte {pos}')
+            break
+        if pos + length > len(data):
+            errors.append(f'frame at byte {pos} is truncated ({len(data) - pos} of {length} bytes)')
+            break
+        duration += ((data[pos + 6] & 3) + 1) * 1024 / ADTS_SAMPLE_RATES[rate]
+        pos += length
+    return duration, errors
+
+
+def check_adts_np(data):
+    """check_adts with the frames chained by array operations instead of walking them one by one."""
+    a = np.frombuffer(data, np.uint8)
+    # every byte pair that looks like a header, decoded at once
+    candidates = np.flatnonzero((a[:-6] == 0xFF) & ((a[1:-5] & 0xF6) == 0xF0))
+    if len(candidates) == 0 or candidates[0] != 0:
+        return 0.0, ['no ADTS frame at byte 0']
+    lengths = ((a[candidates + 3] & 3).astype(np.int64) << 11) | (a[candidates + 4].astype(np.int64) << 3) | (a[candidates + 5] >> 5)
+    rates = (a[candidates + 2] >> 2) & 0xF
+    good = (lengths >= 7) & (rates < len(ADTS_SAMPLE_RATES))
+    seconds = ((a[candidates + 6] & 3).astype(np.int64) + 1) * 1024 / np.array(ADTS_SAMPLE_RATES + (1,) * 3)[rates]
+    # link each frame to the candidate where the next one starts; n (past the last candidate) ends the chain
+    n = len(candidates)
+    ends = candidates + lengths
+    following = np.searchsorted(candidates, ends)
+    linked = good & (following < n) & (candidates[np.minimum(following, n - 1)] == ends)
+    jump = np.append(np.where(linked, following, n), n)
+    # mark the frames of the chain that starts at byte 0 by pointer jumping: after k rounds, all frames
+    # less than 2**k links away are marked, so it takes log2(number of frames) rounds
+    chain = np.zeros(n + 1, bool)
+    chain[0] = True
+    while True:
+        chain[jump[chain]] = True
+        if jump[0] == n:
+            break
+        jump = jump[jump]
+    chain = chain[:n]
+    last = int(np.flatnonzero(chain)[-1])
+    pos, end = int(candidates[last]), int(ends[last])
+    duration = float(seconds[chain][:-1].sum())
+    if not good[last]:
+        return duration, [f'bad ADTS header at byte {pos}']
+    if end > len(data):
+        return duration, [f'frame at byte {pos} is truncated ({len(data) - pos} of {lengths[last]} bytes)']
+    duration += float(seconds[last])
+    if end < len(data):
+        return duration, [f'no ADTS frame at byte {end}']
+    return duration, []
+
+
+def check_ts(data):
+    """:returns: (duration in seconds, list of errors) of a chunk of TS packets"""
+    errors = []
+    if len(data) % TS_PACKET:
+        errors.append(f'{len(data) % TS_PACKET} bytes of a partial packet at the end')
+    count = len(data) // TS_PACKET
+    if count == 0:
+        return 0.0, errors or ['empty']
+    if np is not None:
+        p = np.frombuffer(data, np.uint8, count * TS_PACKET).reshape(count, TS_PACKET)
+        lost = np.flatnonzero(p[:, 0] != 0x47)
+        if len(lost):
+            return None, errors + [f'sync byte lost in {len(lost)} packets, first at byte {lost[0] * TS_PACKET}']
+        pid = ((p[:, 1] & 0x1F).astype(np.int32) << 8) | p[:, 2]
+        afc = (p[:, 3] >> 4) & 3
+        cc = (p[:, 3] & 0xF).astype(np.int8)
+        discontinuity = ((afc & 2) != 0) & (p[:, 4] > 0) & ((p[:, 5] & 0x80) != 0)
+        # the counter goes up by one for each packet with payload of the same PID (0x1FFF is stuffing)
+        with_payload = np.flatnonzero(((afc & 1) != 0) & (pid != 0x1FFF))
+        order = with_payload[np.argsort(pid[with_payload], kind='stable')]
+        step = (cc[order][1:] - cc[order][:-1]) % 16
+        # a step of 0 is an allowed duplicate packet
+        broken = (pid[order][1:] == pid[order][:-1]) & (step > 1) & ~discontinuity[order][1:]
+        if broken.any():
+            errors.append(f'{int(broken.sum())} continuity errors, first at byte {order[1:][broken][0] * TS_PACKET}')
+        # PTS of the PES packets starting in this chunk
+        starts = np.flatnonzero(((p[:, 1] & 0x40) != 0) & ((afc & 1) != 0))
+        offsets = 4 + np.where((afc[starts] & 2) != 0, p[starts, 4].astype(np.int64) + 1, 0)
+        fits = offsets + 14 <= TS_PACKET
+        starts, offsets = starts[fits], offsets[fits]
+        has_pts = ((p[starts, offsets] == 0) & (p[starts, offsets + 1] == 0) & (p[starts, offsets + 2] == 1)
+                   & ((p[starts, offsets + 7] & 0x80) != 0))
+        starts, offsets = starts[has_pts], offsets[has_pts]
+        b = [p[starts, offsets + 9 + k].astype(np.int64) for k in range(5)]
+        pts = (((b[0] >> 1) & 7) << 30) | (b[1] << 22) | ((b[2] >> 1) << 15) | (b[3] << 7) | (b[4] >> 1)
+        pes = list(zip(pid[starts].tolist(), pts.tolist()))
+    else:
+        last_cc = {}
+        pes = []
+        for i in range(count):
+            packet = data[i * TS_PACKET:(i + 1) * TS_PACKET]
+            if packet[0] != 0x47:
+                return None, errors + [f'sync byte lost at byte {i * TS_PACKET}']
+            pid = ((packet[1] & 0x1F) << 8) | packet[2]
+            afc = (packet[3] >> 4) & 3
+            if afc & 1 and pid != 0x1FFF:
+                cc = packet[3] & 0xF
+                discontinuity = afc & 2 and packet[4] > 0 and packet[5] & 0x80
+                if pid in last_cc and (cc - last_cc[pid]) % 16 > 1 and not discontinuity:
+                    errors.append(f'continuity error at byte {i * TS_PACKET}')
+                last_cc[pid] = cc
+                offset = 4 + (packet[4] + 1 if afc & 2 else 0)
+                if packet[1] & 0x40 and offset + 14 <= TS_PACKET and packet[offset:offset + 3] == b'\x00\x00\x01' and packet[offset + 7] & 0x80:
+                    b = packet[offset + 9:offset + 14]
+                    pes.append((pid, (((b[0] >> 1) & 7) << 30) | (b[1] << 22) | ((b[2] >> 1) << 15) | (b[3] << 7) | (b[4] >> 1)))
+    # the duration is the PTS span of the stream with the most PES packets (the video), plus one frame
+    duration = None
+    if pes:
+        streams = {}
+        for stream, pts in pes:
+            streams.setdefault(stream, []).append(pts)
+        stream = max(streams.values(), key=len)
+        # PTS is a 33-bit counter that wraps around (every 26.5 hours), so it's compared as the signed distance
+        # from the first PES modulo 2**33. That also keeps reordered frames before the first one in order.
+        pts = sorted({(t - stream[0] + PTS_WRAP // 2) % PTS_WRAP - PTS_WRAP // 2 for t in stream})
+        steps = [b - a for a, b in zip(pts, pts[1:])]
+        duration = (pts[-1] - pts[0] + (min(steps) if steps else 0)) / PTS_CLOCK
+    return duration, errors
+
+
+class Validator:
+    def __init__(self, media_type, tolerance=0.5, debug=False):
+        """
+        :param media_type: 'audio' (ADTS) or 'video' (TS)
+        :param tolerance: max difference in seconds between a chunk's measured duration and its EXTINF
+        :param debug: print debug info
+        """
+        self.media_type = media_type
+        self.tolerance = tolerance
+        self.debug = debug
+
+    def validate(self, merged, segments):
+        """
+        Check the chunks of a merged file.
+
+        :param merged: the merged file
+        :param segments: list of (name, size, EXTINF duration or None) of the chunks in the file, in order
+        :returns: list of ChunkReports
+        """
+        check = check_adts if self.media_type == 'audio' else check_ts
+        reports = []
+        with open(merged, 'rb') as f:
+            file_size = os.fstat(f.fileno()).st_size
+            view = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if file_size else b''
+            offset = 0
+            for name, size, expected in segments:
+                report = ChunkReport(name, offset, size, expected)
+                if offset + size > file_size:
+                    report.errors.append(f'missing from the file ({max(0, file_size - offset)} of {size} bytes)')
+                else:
+                    report.duration, report.errors = check(view[offset:offset + size])
+                    if expected and report.duration is not None and abs(report.duration - expected) > self.tolerance:
+                        report.errors.append(f'duration {report.duration:.3f}s, EXTINF {expected:.3f}s')
+                reports.append(report)
+                offset += size
+            if offset < file_size:
+                report = ChunkReport('(trailing data)', offset, file_size - offset)
+                report.errors.append(f'{file_size - offset} bytes after the last chunk')
+                reports.append(report)
+            if file_size:
+                view.close()
+        return reports
+
+    def summary(self, reports):
+        """Print the bad chunks and the total duration, :returns: the bad ChunkReports"""
+        bad = [r for r in reports if not r.ok]
+        for r in bad:
+            print(f'[WARN] bad chunk {r.uri} (at byte {r.offset}): {"; ".join(r.errors)}')
+        measured = sum(r.duration or 0 for r in reports)
+        expected = sum(r.expected or 0 for r in reports)
+        line = f'Validated {len(reports)} chunks, {len(bad)} bad. Duration {measured:.1f}s'
+        if expected:
+            line += f' (playlist: {expected:.1f}s)'
+        print(line)
+        return bad
+
+
+def splice(merged, segments, replacements):
+    """
+    Rewrite the merged file with some chunks replaced (e.g. by downloading them again).
+
+    :param merged: the merged file
+    :param segments: list of (name, size) of the chunks in the file, in order
+    :param replacements: dict of name -> file with the new content of the chunk
+    :returns: dict of name -> (size, sha256) of the replaced chunks
+    """
+    merged = Path(merged)
+    temp = merged.with_name(merged.name + '.splice')
+    replaced = {}
+    with merged.open('rb') as src, temp.open('wb') as dst:
+        for name, size in segments:
+            data = src.read(size)
+            if name in replacements:
+                data = Path(replacements[name]).read_bytes()
+                replaced[name] = (len(data), hashlib.sha256(data).hexdigest())
+            dst.write(data)
+    os.replace(temp, merged)
+    return replaced
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check a merged ADTS (.aac) or MPEG-TS (.ts) file frame by frame")
+    parser.add_argument("file", help="the merged file")
+    parser.add_argument("--manifest", help="the .tslazer_*.json manifest of the download (kept with --keep), to check the file chunk by chunk")
+    parser.add_argument("--media", choices=['audio', 'video'], help="default: video for .ts (and unfinished .ts.part) files, audio otherwise")
+    parser.add_argument("--tolerance", type=float, default=0.5, help="Max difference in seconds between a chunk's duration and its EXTINF (default: 0.5)")
+    args = parser.parse_args()
+    media = args.media or ('video' if args.file.removesuffix('.part').endswith('.ts') else 'audio')
+    if args.manifest:
+        manifest = json.loads(Path(args.manifest).read_text(encoding='utf-8'))
+        segments = [(seg['uri'], seg['size'], seg.get('duration')) for seg in manifest['segments']]
+    else:
+        segments = [(Path(args.file).name, Path(args.file).stat().st_size, None)]
+    validator = Validator(media, args.tolerance)
+    np is None and print('[WARN] numpy is not installed, using the slower pure Python checks.')
+    bad = validator.summary(validator.validate(args.file, segments))
+    sys.exit(1 if bad else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -4,12 +4,15 @@
 
 import os
 import argparse
+import threading
 import WebSocketHandler
 
 parser = argparse.ArgumentParser(description="Tslazer's Websocket Driver", formatter_class=argparse.RawTextHelpFormatter)
 parser.add_argument("--chatToken", "-c", type=str, help="Chat Token")
 parser.add_argument("--filename", "-f", type=str, help="Output Filename")
 parser.add_argument("--path", "-p", type=str, help="Path to download the Chat")
+parser.add_argument("--live", action='store_true', help="Capture the chat of a running space live over the websocket, until Ctrl-C (requires websockets)")
+parser.add_argument("--format", nargs='+', choices=['txt', 'jsonl', 'parquet'], default=['txt'], help="Export format(s). jsonl has one decoded record per message, parquet requires pyarrow")
 
 args = parser.parse_args()
 if args.path == None:
@@ -18,4 +21,15 @@ if args.chatToken == None or args.filename == None:
     print("Missing A Required Argument!")
 else:
     # self.playlists.chatToken, self.filename_format, self.path
-    WebSocketHandler.SpaceChat(args.chatToken, args.filename, args.path)
\ No newline at end of file
+    if args.live:
+        liveChat = WebSocketHandler.LiveChat(args.chatToken, args.filename, args.path, args.format)
+        chatThread = threading.Thread(target=liveChat.run)
+        chatThread.start()
+        try:
+            while chatThread.is_alive():
+                chatThread.join(1)
+        except KeyboardInterrupt:
+            liveChat.stop()
+            chatThread.join()
+    else:
+        WebSocketHandler.SpaceChat(args.chatToken, args.filename, args.path, args.format)
\ No newline at end of file
@@ -3,10 +3,22 @@
 # Purpose: Export Twitter Space Chats
 import os
 import json
+import queue
+import asyncio
+import time
 import requests
 import collections
+import contextlib
 
 from dataclasses import dataclass
+from threading import Event, Thread
+
+from utils import requests_retry_session, retry_delay
+
+try:
+    import websockets
+except ImportError:
+    websockets = None
 
 class SpaceChat:
     TwitterUser = collections.namedtuple('TwitterUser', ['name', 'screen_name', 'id'])
@@ -96,6 +108,10 @@ class SpaceChat:
         201 : "ChatCaption"
     }
 
+    # Columns of the structured chat export (see decodeMessage)
+    RecordFields = ("kind", "type", "sender_user_id", "sender_username", "sender_display_name",
+                    "sender_profile_url", "locale", "lang", "timestamp", "body")
+
     # To start, let's get the tokens, we're gonna need that
     @staticmethod
     def get_tokens(chat_token):
@@ -112,130 +128,339 @@ class SpaceChat:
     # It might be more beneficial to use these in conjunction, that way once we have all of the history,
     # We can start getting the live chat history.
     @staticmethod
-    def get_chatData(chatvars, cursor=""):
+    def get_chatData(chatvars, cursor="", session=None, retries=5):
         url = f"{chatvars.chat_replay_endpoint}"
         payload = {"access_token" : chatvars.chat_replay_token,"cursor" : cursor, "limit":100}
+        session = session or requests
 
-        chatrequest = requests.post(url, data=json.dumps(payload))
-        if chatrequest.status_code == 503:
-            # If we get a 503, then that means there is no more chat to get, the twitter space is likely over.
-            return None
-        chatresponse = chatrequest.json()
+        for retry_count in range(retries + 1):
+            if retry_count > 0:
+                time.sleep(retry_delay(retry_count))
+            try:
+                chatrequest = session.post(url, data=json.dumps(payload), timeout=10)
+                if chatrequest.status_code == 503:
+                    # If we get a 503, then that means there is no more chat to get, the twitter space is likely over.
+                    return None
+                chatrequest.raise_for_status()
+                chatresponse = chatrequest.json()
+                return SpaceChat.ChatData(chatresponse["messages"], chatresponse["cursor"])
+            except Exception as e:
+                print(f"\n[ChatExporter] Failed to get chat (Cursor: {cursor}): {e}")
+        raise Exception(f"Failed to get chat after {retries} retries")
+
+    # The cursor of the next page is only known after the current one is fetched, so the pages can't be fetched in parallel.
+    # Instead, the next pages are fetched in a background thread while the current one is being parsed and written.
+    @staticmethod
+    def prefetch_chatData(chatvars, session, cursor="", prefetch=4):
+        pages = queue.Queue(maxsize=prefetch)
+
+        def fetch():
+            nextCursor = cursor
+            try:
+                while True:
+                    chatData = SpaceChat.get_chatData(chatvars, cursor=nextCursor, session=session)
+                    if chatData is None:
+                        break
+                    pages.put(chatData)
+                    nextCursor = chatData.cursor
+                    if nextCursor == "":
+                        break
+            except Exception as e:
+                pages.put(e)
+                return
+            pages.put(None)
 
-        return SpaceChat.ChatData(chatresponse["messages"], chatresponse["cursor"])
+        Thread(target=fetch, daemon=True).start()
+        while (page := pages.get()) is not None:
+            if isinstance(page, Exception):
+                raise page
+            yield page
     
+    # Decode a raw message into a flat record. The nested payload/body JSON is only decoded once here,
+    # both the text log and the structured (JSONL/Parquet) exports are generated from the record.
     @staticmethod
-    def parseMessage(msg):
-        # For Each Message, we want to Provide a readable message in our logs.
-        messagekind = SpaceChat.UserActions[msg["kind"]] # Type of message sent
+    def decodeMessage(msg):
+        messagekind = SpaceChat.UserActions.get(msg["kind"], f"Unknown({msg['kind']})") # Type of message sent
         messagepayload = json.loads(msg["payload"])
-        messagesender = messagepayload["sender"]
-        
-        try:
-            sender = SpaceChat.PayloadSender(messagesender["twitter_id"], messagesender["username"], messagesender["display_name"], messagesender["profile_image_url"])
-            fullSenderData = f"Sender Username:{sender.sender_username} Sender Display Name: {sender.sender_display_name} Sender User ID: {sender.sender_user_id}"
-        except:
-            sender = SpaceChat.PayloadSenderLite(messagesender["twitter_id"])
-            fullSenderData = f"Sender User ID: {sender.sender_user_id}"
-            pass
-       
+        messagesender = messagepayload.get("sender", {})
+        record = {
+            "kind": messagekind,
+            "type": None,
+            "sender_user_id": messagesender.get("twitter_id"),
+            "sender_username": None,
+            "sender_display_name": None,
+            "sender_profile_url": None,
+            "locale": messagesender.get("locale"),
+            "lang": messagesender.get("lang"),
+            "timestamp": messagepayload.get("timestamp"),
+            "body": None,
+        }
+        if all(key in messagesender for key in ("username", "display_name", "profile_image_url")):
+            record["sender_username"] = messagesender["username"]
+            record["sender_display_name"] = messagesender["display_name"]
+            record["sender_profile_url"] = messagesender["profile_image_url"]
+
         if messagekind == "Chat":
-            messagetype = SpaceChat.RecordableActionTypes[json.loads(messagepayload["body"])["type"]]
+            messagebody = json.loads(messagepayload["body"])
+            record["type"] = SpaceChat.RecordableActionTypes.get(messagebody["type"], f"Unknown({messagebody['type']})")
+            record["body"] = messagebody.get("body")
+            record["timestamp"] = record["timestamp"] or messagebody.get("timestamp")
 
-            if messagetype == "Chat" or messagetype == "Heart" or messagetype == "ServerAudioTranscription":
-                message = messagepayload["body"]
-                message = json.loads(message)["body"]
-                sender = SpaceChat.PayloadSender(messagesender["twitter_id"], messagesender["username"], messagesender["display_name"], messagesender["profile_image_url"])
-                return f"Message: {message} {fullSenderData} Type: {messagetype}"
-            
-            if messagetype == "HydraControlMessage":
-                message = "Hydra Control Message"
-                
-                # Pack the Exposed Data into their own parts
-                try:
-                    locale = messagesender["locale"]
-                except:
-                    locale = "None"
-                    
-                try:
-                    lang = messagesender["lang"]
-                except:
-                    lang = "None"
-                return f"{message} {fullSenderData} Sender Locale: {locale} Sender Lang: {lang} Type: {messagetype}"
-
-            else:
-                return f"{messagetype}"
-                
-            
         if messagekind == "Control":
             try:
-                action = SpaceChat.SendableActions[messagepayload["kind"]]
-            except:
-                action = SpaceChat.RecordableActionTypes[messagepayload["type"]]
-                
-            if action != "Presence" or action != "Roster":
-                try:
-                    locale = messagesender["locale"]
-                except:
-                    locale = "None"
-                    
+                record["type"] = SpaceChat.SendableActions[messagepayload["kind"]]
+            except KeyError:
+                record["type"] = SpaceChat.RecordableActionTypes.get(messagepayload.get("type"), "Unknown")
+        return {name: SpaceChat.columnValue(name, value) for name, value in record.items()}
+
+    # The Parquet export has a fixed schema (timestamp is an integer in ms, the rest are strings),
+    # so values of another type are converted while decoding, instead of failing the whole conversion at the end.
+    @staticmethod
+    def columnValue(name, value):
+        if value is None:
+            return None
+        if name == "timestamp":
+            try:
+                return int(value)
+            except (TypeError, ValueError):
                 try:
-                    lang = messagesender["lang"]
-                except:
-                    lang = "None"                
-                return f"Action: {action} {fullSenderData}" if (locale == "None" or lang == "None") else f"Action: {action} {fullSenderData} Sender Locale: {locale} Sender Lang: {lang}"
-            
-        if messagekind == "Auth":
-            pass
-        
+                    return int(float(value))
+                except (TypeError, ValueError, OverflowError):
+                    return None
+        return value if isinstance(value, str) else str(value)
+
+    # For Each Message, we want to Provide a readable message in our logs.
+    @staticmethod
+    def formatMessage(record):
+        if record["sender_username"] is not None:
+            fullSenderData = f"Sender Username:{record['sender_username']} Sender Display Name: {record['sender_display_name']} Sender User ID: {record['sender_user_id']}"
         else:
-            return f"{messagekind}"
-               
+            fullSenderData = f"Sender User ID: {record['sender_user_id']}"
+        locale = record["locale"] or "None"
+        lang = record["lang"] or "None"
+        messagetype = record["type"]
+
+        if record["kind"] == "Chat":
+            if messagetype == "Chat" or messagetype == "Heart" or messagetype == "ServerAudioTranscription":
+                return f"Message: {record['body']} {fullSenderData} Type: {messagetype}"
+            if messagetype == "HydraControlMessage":
+                return f"Hydra Control Message {fullSenderData} Sender Locale: {locale} Sender Lang: {lang} Type: {messagetype}"
+            return f"{messagetype}"
+
+        if record["kind"] == "Control":
+            return f"Action: {messagetype} {fullSenderData}" if (locale == "None" or lang == "None") else f"Action: {messagetype} {fullSenderData} Sender Locale: {locale} Sender Lang: {lang}"
+
+        if record["kind"] == "Auth":
+            return None
+        return f"{record['kind']}"
+
+    @staticmethod
+    def parseMessage(msg):
+        return SpaceChat.formatMessage(SpaceChat.decodeMessage(msg))
+
+    # Decode each page as it comes in, so only one page of messages is in memory at a time.
+    @staticmethod
+    def decodePages(pages):
+        for chatData in pages:
+            yield chatData, [SpaceChat.decodeMessage(raw_message) for raw_message in chatData.messages]
+
+    # Writers for each export format: file extension -> function that turns a record into a line (or None to skip it)
+    Formats = {
+        "txt": lambda record: SpaceChat.formatMessage(record),
+        "jsonl": lambda record: json.dumps(record, ensure_ascii=False),
+    }
+
     # Get all of the chat history
+    # Every page is written and flushed as soon as it's decoded, and the cursor of the next page is saved to a checkpoint file.
+    # If the export is interrupted, running it again resumes from the checkpoint.
     @staticmethod
-    def get_chatHistory(chatvars, chatfilename="chat", path=os.getcwd()):
-        chatData = SpaceChat.get_chatData(chatvars)
-
-        chatCursor = chatData.cursor
-        chatHistory = chatData.messages
-        parsedMessages = list()
-        messagesCollected = 0
-        while chatCursor != "":
-            try:
-                chat_data = SpaceChat.get_chatData(chatvars, cursor=chatCursor)
-
-                chatCursor = chat_data.cursor
-                chatHistory.extend(chat_data.messages)
-                
-                messagesCollected += len(chat_data.messages)
-                print(f"Captured {messagesCollected} Messages [Cursor: {chatCursor}] ", end="\r")
-            except Exception:
-                pass
-        
-        print("\n Finished Capturing Chat! Now Parsing...")
-        parsed_messages = 0
-        for raw_message in chatHistory:
-            parsed_message = SpaceChat.parseMessage(raw_message)
-            parsedMessages.append(parsed_message)
-            parsed_messages += 1
-            print(f"Parsed {parsed_messages} Messages", end="\r")
-                
-            
-#        for message in chatHistory:
-#            parsed_message = SpaceChat.parseMessage(message)
-#            parsedMessages.append(parsed_message)
-            
-                
-        with open(os.path.join(path, chatfilename + '.txt'), 'w', encoding='utf-8') as chatwriter:
-            for message in parsedMessages:
-                chatwriter.write(message)
-                chatwriter.write('\n')
-                
-    def __init__(self, chat_token, chatfilename, filepath=os.getcwd()):
+    def get_chatHistory(chatvars, chatfilename="chat", path=os.getcwd(), formats=("txt",)):
+        session = requests_retry_session()
+        chatfiles = SpaceChat.chatFiles(chatfilename, path, formats)
+        checkpointfile = os.path.join(path, chatfilename + '.cursor')
+        checkpoint = {"cursor": "", "offsets": {}, "pages": 0, "messages": 0}
+        if os.path.exists(checkpointfile) and all(os.path.exists(f) for f in chatfiles.values()):
+            with open(checkpointfile, encoding='utf-8') as f:
+                checkpoint = json.load(f)
+            # drop whatever was written after the last checkpoint
+            for fmt, chatfile in chatfiles.items():
+                os.truncate(chatfile, checkpoint["offsets"].get(fmt, 0))
+            print(f"[ChatExporter] Resuming from {checkpoint['messages']} Messages [Cursor: {checkpoint['cursor']}]")
+
+        pagesCollected = checkpoint["pages"]
+        messagesCollected = checkpoint["messages"]
+        startTime = time.time()
+        pages = SpaceChat.prefetch_chatData(chatvars, session, cursor=checkpoint["cursor"])
+        writers = {fmt: open(chatfile, 'a' if checkpoint["offsets"] else 'w', encoding='utf-8') for fmt, chatfile in chatfiles.items()}
+
+        try:
+            for chatData, records in SpaceChat.decodePages(pages):
+                for fmt, chatwriter in writers.items():
+                    for record in records:
+                        line = SpaceChat.Formats[fmt](record)
+                        if line is not None:
+                            chatwriter.write(line)
+                            chatwriter.write('\n')
+                    chatwriter.flush()
+
+                pagesCollected += 1
+                messagesCollected += len(chatData.messages)
+                if chatData.cursor:
+                    offsets = {fmt: chatwriter.tell() for fmt, chatwriter in writers.items()}
+                    checkpoint = {"cursor": chatData.cursor, "offsets": offsets, "pages": pagesCollected, "messages": messagesCollected}
+                    with open(checkpointfile + '.tmp', 'w', encoding='utf-8') as f:
+                        json.dump(checkpoint, f)
+                    os.replace(checkpointfile + '.tmp', checkpointfile)
+                else:
+                    # the last page is written. An empty cursor means "from the beginning", so don't leave it to resume from
+                    with contextlib.suppress(FileNotFoundError):
+                        os.remove(checkpointfile)
+
+                elapsed = max(time.time() - startTime, 1e-6)
+                print(f"Captured {messagesCollected} Messages in {pagesCollected} Pages ({pagesCollected / elapsed:.1f} Pages/s, {messagesCollected / elapsed:.0f} Messages/s) [Cursor: {chatData.cursor}] ", end="\r")
+        finally:
+            for chatwriter in writers.values():
+                chatwriter.close()
+
+        # also when there was no page at all (no chat, or it expired), then no checkpoint was written
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(checkpointfile)
+        print("\n Finished Capturing Chat!")
+        SpaceChat.finishChatFiles(chatfiles, chatfilename, path, formats)
+
+    # Files written line by line for the requested formats. parquet is converted from the jsonl file at the end.
+    @staticmethod
+    def chatFiles(chatfilename, path, formats):
+        lineFormats = [fmt for fmt in SpaceChat.Formats if fmt in formats or (fmt == "jsonl" and "parquet" in formats)]
+        return {fmt: os.path.join(path, f"{chatfilename}.{fmt}") for fmt in lineFormats}
+
+    @staticmethod
+    def finishChatFiles(chatfiles, chatfilename, path, formats):
+        if "parquet" in formats:
+            converted = SpaceChat.convertToParquet(chatfiles["jsonl"], os.path.join(path, chatfilename + '.parquet'))
+            if converted and "jsonl" not in formats:
+                os.remove(chatfiles["jsonl"])
+
+    # Columnar copy of the JSONL export for bulk analysis. Requires pyarrow.
+    # Returns False if it couldn't be made, the JSONL export is kept then.
+    @staticmethod
+    def convertToParquet(jsonlfile, parquetfile):
+        try:
+            import pyarrow.json
+            import pyarrow.parquet
+        except ImportError:
+            print(f"[ChatExporter] Parquet export requires pyarrow (pip install pyarrow). The JSONL export is kept at {jsonlfile}.")
+            return False
+        # explicit schema, so columns that happen to be all null still get a proper type
+        fields = [(name, pyarrow.int64() if name == "timestamp" else pyarrow.string()) for name in SpaceChat.RecordFields]
+        try:
+            table = pyarrow.json.read_json(jsonlfile, parse_options=pyarrow.json.ParseOptions(explicit_schema=pyarrow.schema(fields)))
+            pyarrow.parquet.write_table(table, parquetfile, compression='zstd')
+        except (pyarrow.ArrowException, OSError) as e:
+            print(f"[ChatExporter] Parquet export failed: {e}. The JSONL export is kept at {jsonlfile}.")
+            return False
+        print(f"[ChatExporter] Saved {table.num_rows} Messages to {parquetfile}")
+        return True
+
+    def __init__(self, chat_token, chatfilename, filepath=os.getcwd(), formats=("txt",)):
         self.chat_token = chat_token
         self.chatfilename = chatfilename
         self.filepath = filepath
+        self.formats = formats
         
         # Download the chat
         chatTokens = SpaceChat.get_tokens(self.chat_token)
-        SpaceChat.get_chatHistory(chatTokens, self.chatfilename, self.filepath)
\ No newline at end of file
+        SpaceChat.get_chatHistory(chatTokens, self.chatfilename, self.filepath, self.formats)
+
+
+# Live chat of a running space, received over the chat websocket while the audio is being downloaded.
+class LiveChat:
+    def __init__(self, chat_token, chatfilename, filepath=os.getcwd(), formats=("txt",), buffer=1000):
+        """
+        :param chat_token: chat token of the space
+        :param chatfilename: output filename without extension
+        :param filepath: output directory
+        :param formats: export formats, same as SpaceChat
+        :param buffer: max number of received messages waiting to be written. When it's full, reading from the websocket pauses.
+        """
+        if websockets is None:
+            raise ImportError("Live chat capture requires websockets. Install it with: pip install websockets")
+        self.chat_token = chat_token
+        self.chatfilename = chatfilename
+        self.filepath = filepath
+        self.formats = formats
+        self.buffer = buffer
+        self.stopped = Event()
+        self.messagesCollected = 0
+
+    def stop(self):
+        """Stop capturing. The messages already received are still written."""
+        self.stopped.set()
+
+    # Messages are only sent to us after authenticating and joining the room, using the codes in SpaceChat.UserActions/SendableActions.
+    def handshake(self, chatvars):
+        auth = {"kind": 3, "payload": json.dumps({"access_token": chatvars.access_token})}
+        join = {"kind": 2, "payload": json.dumps({"kind": 1, "body": json.dumps({"room": chatvars.room_id})})}
+        return [json.dumps(auth), json.dumps(join)]
+
+    async def receive(self, chatvars, messages):
+        url = chatvars.endpoint.replace("https://", "wss://", 1).replace("http://", "ws://", 1) + "/chatapi/v1/chatnow"
+        retry_count = 0
+        while not self.stopped.is_set():
+            if retry_count > 0:
+                await asyncio.sleep(retry_delay(retry_count))
+            try:
+                async with websockets.connect(url) as ws:
+                    for message in self.handshake(chatvars):
+                        await ws.send(message)
+                    print("[ChatExporter] Connected to live chat.")
+                    retry_count = 0
+                    while not self.stopped.is_set():
+                        try:
+                            raw_message = await asyncio.wait_for(ws.recv(), 1)
+                        except asyncio.TimeoutError:
+                            continue
+                        await messages.put(json.loads(raw_message))
+            except Exception as e:
+                retry_count += 1
+                print(f"\n[ChatExporter] Live chat connection lost, reconnecting (retry {retry_count}): {e!r}")
+
+    async def write(self, chatfiles, messages):
+        writers = {fmt: open(chatfile, 'a', encoding='utf-8') for fmt, chatfile in chatfiles.items()}
+        try:
+            while (raw_message := await messages.get()) is not None:
+                try:
+                    record = SpaceChat.decodeMessage(raw_message)
+                except Exception as e:
+                    print(f"\n[ChatExporter] Failed to decode live message: {e!r}")
+                    continue
+                for fmt, chatwriter in writers.items():
+                    line = SpaceChat.Formats[fmt](record)
+                    if line is not None:
+                        chatwriter.write(line)
+                        chatwriter.write('\n')
+                self.messagesCollected += 1
+                # flush once the backlog is written, not after every message
+                if messages.empty():
+                    for chatwriter in writers.values():
+                        chatwriter.flush()
+        finally:
+            for chatwriter in writers.values():
+                chatwriter.close()
+
+    async def _run(self, chatvars, chatfiles):
+        messages = asyncio.Queue(maxsize=self.buffer)
+        writer = asyncio.create_task(self.write(chatfiles, messages))
+        try:
+            await self.receive(chatvars, messages)
+        finally:
+            await messages.put(None)
+            await writer
+
+    def run(self):
+        """Capture the live chat until stop() is called."""
+        chatvars = SpaceChat.get_tokens(self.chat_token)
+        chatfiles = SpaceChat.chatFiles(self.chatfilename, self.filepath, self.formats)
+        asyncio.run(self._run(chatvars, chatfiles))
+        print(f"\n[ChatExporter] Captured {self.messagesCollected} Live Messages")
+        SpaceChat.finishChatFiles(chatfiles, self.chatfilename, self.filepath, self.formats)
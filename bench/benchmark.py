@@ -0,0 +1,108 @@
+# Benchmark the full tslazer flow (playlist -> download -> merge -> remux) against the local mock CDN.
+# tslazer runs as a subprocess, so its peak RSS can be measured separately from the mock server.
+#
+# Examples:
+#   python bench/benchmark.py --segments 500
+#   python bench/benchmark.py --media video --latency 0.1 --throttle 0.05 -- --threads 40 --engine async
+#   python bench/benchmark.py --aes-rotate 50 --truncate 0.02 --runs 3 --json bench_output.txt
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+from pathlib import Path
+
+import mock_server
+
+TSLAZER = Path(__file__).resolve().parent.parent / 'tslazer.py'
+
+
+# Runs tslazer.py as __main__ and writes the peak RSS of the python process (in bytes) to the file given as the first argument.
+# getrusage of the child from the outside would also include ffmpeg, which is not what we want to measure.
+WRAPPER = """
+import atexit, resource, runpy, sys
+rss_file = sys.argv.pop(1)
+@atexit.register
+def write_rss():
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in KB on Linux but in bytes on macOS
+    open(rss_file, 'w').write(str(rss if sys.platform == 'darwin' else rss * 1024))
+sys.argv.pop(0)
+sys.path.insert(0, sys.argv[0].rsplit('/', 1)[0])
+runpy.run_path(sys.argv[0], run_name='__main__')
+"""
+
+
+def run_once(args, extra):
+    cdn = mock_server.from_arguments(args)
+    server = cdn.serve()
+    port = server.server_address[1]
+    try:
+        with tempfile.TemporaryDirectory() as out:
+            rss_file = Path(out) / 'rss'
+            command = [sys.executable, '-c', WRAPPER, str(rss_file), str(TSLAZER), '-d', cdn.playlist_url(port, args.live), '-o', 'bench', '-p', out, '--no-cache', *extra]
+            if args.live:
+                command.append('--live')
+            start = time.time()
+            r = subprocess.run(command, stdout=None if args.verbose else subprocess.DEVNULL, stderr=subprocess.STDOUT)
+            wall = time.time() - start
+            # a failed download leaves a temp file (bench.ts.part, bench_merged.aac) and its manifest for resuming
+            outputs = [f for f in Path(out).glob('bench.*') if f.suffix in ('.m4a', '.ts', '.mp4')]
+            output_size = outputs[0].stat().st_size if outputs else 0
+            leftover = not {'--keep', '-k'} & set(extra) and any(Path(out).glob('.tslazer_*.json'))
+            peak_rss = int(rss_file.read_text()) if rss_file.exists() else 0
+        with urllib.request.urlopen(f'http://127.0.0.1:{port}/stats') as f:
+            stats = json.load(f)
+    finally:
+        server.shutdown()
+        server.server_close()
+    return {
+        'ok': r.returncode == 0 and output_size > 0 and not leftover,
+        'wall': wall,
+        'segments_per_s': args.segments / wall,
+        'mb_per_s': stats['bytes'] / wall / 1024 ** 2,
+        'peak_rss_mb': peak_rss / 1024 ** 2,
+        'output_mb': output_size / 1024 ** 2,
+        'server': stats,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark tslazer against a local mock pscp.tv server. Arguments after -- are passed to tslazer.")
+    mock_server.add_arguments(parser)
+    parser.add_argument("--runs", type=int, default=1, help="Number of runs")
+    parser.add_argument("--json", metavar="FILE", help="Append the results of each run to FILE as JSON lines")
+    parser.add_argument("--verbose", action='store_true', help="Show the output of tslazer")
+    argv = sys.argv[1:]
+    extra = []
+    if '--' in argv:
+        extra = argv[argv.index('--') + 1:]
+        argv = argv[:argv.index('--')]
+    args = parser.parse_args(argv)
+
+    results = []
+    for i in range(args.runs):
+        result = run_once(args, extra)
+        results.append(result)
+        server = result['server']
+        print(f"run {i + 1}/{args.runs}: {'ok' if result['ok'] else 'FAILED'} "
+              f"wall {result['wall']:.2f}s, {result['segments_per_s']:.1f} segments/s, {result['mb_per_s']:.2f} MB/s, "
+              f"peak RSS {result['peak_rss_mb']:.1f} MB, output {result['output_mb']:.1f} MB "
+              f"[{server['requests']} requests, {server['throttled']} throttled, {server['truncated']} truncated, {server['corrupted']} corrupted, "
+              f"{server['sub_404']} sub playlist 404s, {server['keys']} keys, {server['not_modified']} playlists not modified]")
+        if args.json:
+            with open(args.json, 'a', encoding='utf-8') as f:
+                f.write(json.dumps({'args': vars(args), 'tslazer_args': extra, **result}) + '\n')
+
+    if args.runs > 1:
+        walls = [r['wall'] for r in results]
+        print(f"wall median {statistics.median(walls):.2f}s, min {min(walls):.2f}s, max {max(walls):.2f}s")
+    if not all(r['ok'] for r in results):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
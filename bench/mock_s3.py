@@ -0,0 +1,158 @@
+# Local stand-in for an S3-compatible object store (MinIO-style, path-style URLs), to try --storage s3:// offline.
+# Implements only what tslazer uses: PutObject, the multipart upload calls, HeadObject and GetObject.
+# Objects are kept in a directory, parts in memory until the upload is completed. Requests aren't authenticated.
+#
+#   python bench/mock_s3.py --port 9000 --dir /tmp/s3
+#   AWS_ACCESS_KEY_ID=x AWS_SECRET_ACCESS_KEY=x AWS_DEFAULT_REGION=us-east-1 \
+#     python tslazer.py -d ... --storage s3://archive/spaces --s3-endpoint http://127.0.0.1:9000
+import argparse
+import hashlib
+import json
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.parse import parse_qs, unquote
+
+
+class MockS3:
+    def __init__(self, directory):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.uploads = {}  # upload ID -> {part number: bytes}
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.stats = {'requests': 0, 'parts': 0, 'bytes': 0, 'completed': 0, 'aborted': 0, 'put': 0, 'max_parallel_parts': 0}
+
+    def count(self, **stats):
+        with self.lock:
+            for k, v in stats.items():
+                self.stats[k] += v
+
+    def object(self, path):
+        # /bucket/key -> directory/bucket/key
+        return self.directory / unquote(path).lstrip('/')
+
+    def serve(self, port=0):
+        """Start serving in a background thread. :returns: the server"""
+        s3 = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def send(self, body=b'', code=200, headers=None, content_type='application/xml'):
+                self.send_response(code)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                for k, v in (headers or {}).items():
+                    self.send_header(k, v)
+                self.end_headers()
+                self.command != 'HEAD' and self.wfile.write(body)
+
+            def body(self):
+                return self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+            def parse(self):
+                s3.count(requests=1)
+                path, _, query = self.path.partition('?')
+                return path, {k: v[0] for k, v in parse_qs(query, keep_blank_values=True).items()}
+
+            def do_GET(self):
+                path, _ = self.parse()
+                if path == '/stats':
+                    return self.send(json.dumps(s3.stats).encode(), content_type='application/json')
+                f = s3.object(path)
+                if not f.is_file():
+                    return self.send(b'<Error><Code>NoSuchKey</Code></Error>', 404)
+                self.send(f.read_bytes(), content_type='application/octet-stream')
+
+            def do_HEAD(self):
+                path, _ = self.parse()
+                f = s3.object(path)
+                if not f.is_file():
+                    return self.send(code=404)
+                self.send(f.read_bytes(), content_type='application/octet-stream')
+
+            def do_PUT(self):
+                path, query = self.parse()
+                data = self.body()
+                etag = '"' + hashlib.md5(data).hexdigest() + '"'
+                if 'uploadId' in query:
+                    with s3.lock:
+                        s3.in_flight += 1
+                        s3.stats['max_parallel_parts'] = max(s3.stats['max_parallel_parts'], s3.in_flight)
+                    # like a real upload, a part takes a moment
+                    time.sleep(0.05)
+                    with s3.lock:
+                        s3.in_flight -= 1
+                        if query['uploadId'] not in s3.uploads:
+                            return self.send(b'<Error><Code>NoSuchUpload</Code></Error>', 404)
+                        s3.uploads[query['uploadId']][int(query['partNumber'])] = data
+                    s3.count(parts=1, bytes=len(data))
+                    return self.send(headers={'ETag': etag})
+                f = s3.object(path)
+                f.parent.mkdir(parents=True, exist_ok=True)
+                f.write_bytes(data)
+                s3.count(put=1, bytes=len(data))
+                self.send(headers={'ETag': etag})
+
+            def do_POST(self):
+                path, query = self.parse()
+                self.body()
+                if 'uploads' in query:
+                    upload_id = uuid.uuid4().hex
+                    with s3.lock:
+                        s3.uploads[upload_id] = {}
+                    bucket, _, key = path.lstrip('/').partition('/')
+                    return self.send(f'<InitiateMultipartUploadResult><Bucket>{bucket}</Bucket><Key>{key}</Key>'
+                                     f'<UploadId>{upload_id}</UploadId></InitiateMultipartUploadResult>'.encode())
+                if 'uploadId' in query:
+                    with s3.lock:
+                        parts = s3.uploads.pop(query['uploadId'], None)
+                    if parts is None:
+                        return self.send(b'<Error><Code>NoSuchUpload</Code></Error>', 404)
+                    f = s3.object(path)
+                    f.parent.mkdir(parents=True, exist_ok=True)
+                    with f.open('wb') as fp:
+                        for number in sorted(parts):
+                            fp.write(parts[number])
+                    s3.count(completed=1)
+                    return self.send(f'<CompleteMultipartUploadResult><Key>{path}</Key><ETag>"{len(parts)}"</ETag>'
+                                     '</CompleteMultipartUploadResult>'.encode())
+                self.send(b'<Error><Code>NotImplemented</Code></Error>', 501)
+
+            def do_DELETE(self):
+                path, query = self.parse()
+                if 'uploadId' in query:
+                    with s3.lock:
+                        s3.uploads.pop(query['uploadId'], None)
+                    s3.count(aborted=1)
+                    return self.send(code=204)
+                s3.object(path).unlink(missing_ok=True)
+                self.send(code=204)
+
+        server = ThreadingHTTPServer(('127.0.0.1', port), Handler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Mock S3-compatible object store for trying tslazer --storage")
+    parser.add_argument("--port", type=int, default=9000)
+    parser.add_argument("--dir", default='mock_s3', help="Directory to keep the objects in (as <bucket>/<key>)")
+    args = parser.parse_args()
+    s3 = MockS3(args.dir)
+    server = s3.serve(args.port)
+    print(f"Serving S3 at http://127.0.0.1:{args.port}, objects are saved in {args.dir}. Use:\n"
+          f"  tslazer ... --storage s3://bucket/prefix --s3-endpoint http://127.0.0.1:{args.port}")
+    print(f"Stats: http://127.0.0.1:{args.port}/stats")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
@@ -0,0 +1,293 @@
+# Local mock of the pscp.tv HLS endpoints, for benchmarking tslazer offline.
+# Serves master, sub and dynamic playlists laid out like the real CDN (see twitter_m3u8_info.md),
+# and synthetic ADTS (audio) or MPEG-TS (video) chunks cut from a short clip generated with ffmpeg.
+# Faults can be injected: latency, bandwidth limit, 429 throttling, 404 on sub playlists,
+# truncated chunks (size mismatch) and AES-128 encryption with key rotation.
+import argparse
+import hashlib
+import json
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+from Crypto.Cipher import AES
+from Crypto.Util.Padding import pad
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from utils import parse_size
+
+REGION = 'ap-northeast-1'
+DEPLOY = f'periscope-replay-direct-prod-{REGION}-public'
+JWT = 'eyJhbGciOiJIUzI1NiJ9.eyJIZWlnaHQiOjcyMH0.bench'
+# EXT-X-PROGRAM-DATE-TIME of the first chunk (2024-07-05T15:17:40Z)
+PROGRAM_START = 1720192660
+
+
+def generate_clip(media, seconds=10, segment_seconds=3.0):
+    """
+    Generate a short clip with ffmpeg, as a list of ADTS frames (audio),
+    or of TS segments of segment_seconds (video: H.264 and AAC like real broadcasts, each segment starts with a keyframe).
+    """
+    if media == 'audio':
+        command = ['ffmpeg', '-loglevel', 'error', '-f', 'lavfi', '-i', f'sine=frequency=440:duration={seconds}',
+                   '-c:a', 'aac', '-b:a', '128k', '-f', 'adts', 'pipe:1']
+        data = subprocess.run(command, capture_output=True, check=True).stdout
+        units = []
+        pos = 0
+        while pos < len(data):
+            # ADTS frame length is 13 bits starting at bit 30 of the header
+            size = ((data[pos + 3] & 0x03) << 11) | (data[pos + 4] << 3) | (data[pos + 5] >> 5)
+            units.append(data[pos:pos + size])
+            pos += size
+        return units
+    with tempfile.TemporaryDirectory() as temp:
+        command = ['ffmpeg', '-loglevel', 'error', '-f', 'lavfi', '-i', f'testsrc=size=1280x720:rate=30:duration={seconds}',
+                   '-f', 'lavfi', '-i', f'sine=frequency=440:duration={seconds}',
+                   '-c:v', 'libx264', '-preset', 'ultrafast', '-b:v', '4M', '-force_key_frames', f'expr:gte(t,n_forced*{segment_seconds})',
+                   '-c:a', 'aac', '-b:a', '128k',
+                   '-f', 'segment', '-segment_format', 'mpegts', '-segment_time', str(segment_seconds), f'{temp}/%05d.ts']
+        subprocess.run(command, capture_output=True, check=True)
+        return [f.read_bytes() for f in sorted(Path(temp).glob('*.ts'))]
+
+
+class MockCDN:
+    def __init__(self, media='audio', segments=100, segment_seconds=3.0, live=False, speed=1.0,
+                 latency=0.0, bandwidth=None, throttle=0.0, sub_404=0, truncate=0.0, aes_rotate=0, seed=0, corrupt=0.0):
+        """
+        :param media: 'audio' (space, ADTS chunks) or 'video' (broadcast, TS chunks)
+        :param segments: number of chunks
+        :param segment_seconds: duration of each chunk
+        :param live: chunks become available over time, as if the stream is still running
+        :param speed: how much faster than real time chunks become available in live mode
+        :param latency: seconds to wait before answering each chunk/key request
+        :param bandwidth: max bytes/s sent for each chunk response
+        :param throttle: probability of answering a chunk request with 429
+        :param sub_404: number of sub playlist requests answered with 404 before it becomes available
+        :param truncate: probability of closing a chunk response before all bytes declared by Content-Length are sent
+        :param aes_rotate: encrypt chunks with AES-128, using a new key every aes_rotate chunks (0: no encryption)
+        :param seed: random seed for the injected faults
+        :param corrupt: probability of serving a chunk with a run of zeroed bytes in the middle (same size, so only a content check notices)
+        """
+        self.media = media
+        self.segments = segments
+        self.segment_seconds = segment_seconds
+        self.live = live
+        self.speed = speed
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.throttle = throttle
+        self.sub_404 = sub_404
+        self.truncate = truncate
+        self.aes_rotate = aes_rotate
+        self.corrupt = corrupt
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.stats = {'requests': 0, 'chunks': 0, 'bytes': 0, 'throttled': 0, 'sub_404': 0, 'truncated': 0, 'keys': 0, 'not_modified': 0, 'corrupted': 0}
+
+        clip_seconds = max(10, segment_seconds * 3)
+        self.units = generate_clip(media, clip_seconds, segment_seconds)
+        if media == 'audio':
+            # AAC frames have 1024 samples, the clip is 44.1kHz
+            self.units_per_segment = max(1, round(segment_seconds * 44100 / 1024))
+        else:
+            # already cut into segments
+            self.units_per_segment = 1
+        self.start_time = time.time()
+
+        kind = 'audio-space/' if media == 'audio' else ''
+        self.base = f'/Transcoding/v1/hls/bench/non_transcode/{REGION}/{DEPLOY}/{kind}'
+        self.transcode_base = f'/Transcoding/v1/hls/bench/transcode/{REGION}/{DEPLOY}/{JWT}/{kind}'
+        self.ext = 'aac' if media == 'audio' else 'ts'
+
+    def available(self):
+        """Number of chunks that can be listed right now."""
+        if not self.live:
+            return self.segments
+        elapsed = (time.time() - self.start_time) * self.speed
+        return min(self.segments, int(elapsed / self.segment_seconds) + 1)
+
+    def chunk_name(self, i):
+        return f'chunk_{1720000000000000000 + i * int(self.segment_seconds * 1e9)}_{i}_a.{self.ext}'
+
+    def key(self, k):
+        return bytes([k % 256]) * 16
+
+    def iv(self, i):
+        return i.to_bytes(16, 'big')
+
+    def chunk(self, i, corrupt=False):
+        # each chunk is a contiguous part of the clip, so its timestamps and TS continuity counters are consistent
+        start = i * self.units_per_segment % max(1, len(self.units) - self.units_per_segment)
+        data = b''.join(self.units[start:start + self.units_per_segment])
+        if corrupt:
+            middle = len(data) // 2
+            data = data[:middle] + bytes(400) + data[middle + 400:]
+        if self.aes_rotate:
+            data = AES.new(self.key(i // self.aes_rotate), AES.MODE_CBC, iv=self.iv(i)).encrypt(pad(data, AES.block_size))
+        return data
+
+    def media_playlist(self, start, end, suffix='', endlist=True):
+        lines = ['#EXTM3U', '#EXT-X-VERSION:6', f'#EXT-X-TARGETDURATION:{int(self.segment_seconds + 0.999)}', f'#EXT-X-MEDIA-SEQUENCE:{start}']
+        for i in range(start, end):
+            if self.aes_rotate:
+                # pscp.tv sends the key tag before every chunk
+                lines.append(f'#EXT-X-KEY:METHOD=AES-128,URI="key_{i // self.aes_rotate}.bin",IV=0x{self.iv(i).hex()}')
+            pdt = datetime.fromtimestamp(PROGRAM_START + i * self.segment_seconds, tz=timezone.utc)
+            lines.append(f'#EXT-X-PROGRAM-DATE-TIME:{pdt.isoformat(timespec="milliseconds").replace("+00:00", "Z")}')
+            lines.append(f'#EXTINF:{self.segment_seconds:.3f},')
+            lines.append(self.chunk_name(i) + suffix)
+        if endlist:
+            lines.append('#EXT-X-ENDLIST')
+        return '\n'.join(lines) + '\n'
+
+    def count(self, **stats):
+        with self.lock:
+            for k, v in stats.items():
+                self.stats[k] += v
+
+    def chance(self, p):
+        with self.lock:
+            return self.random.random() < p
+
+    def serve(self, port=0):
+        """Start serving in a background thread. :returns: the server (use server.server_address for the port)"""
+        cdn = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def send(self, body, code=200, content_type='application/vnd.apple.mpegurl', declared=None):
+                self.send_response(code)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(declared or len(body)))
+                self.end_headers()
+                if cdn.bandwidth:
+                    block = max(1, cdn.bandwidth // 20)
+                    for i in range(0, len(body), block):
+                        self.wfile.write(body[i:i + block])
+                        time.sleep(len(body[i:i + block]) / cdn.bandwidth)
+                else:
+                    self.wfile.write(body)
+                if declared:
+                    self.close_connection = True
+
+            def send_playlist(self, body):
+                # conditional requests, like the CDN's ETag handling
+                etag = '"' + hashlib.md5(body).hexdigest() + '"'
+                if self.headers.get('If-None-Match') == etag:
+                    cdn.count(not_modified=1)
+                    self.send_response(304)
+                    self.send_header('ETag', etag)
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/vnd.apple.mpegurl')
+                self.send_header('Content-Length', str(len(body)))
+                self.send_header('ETag', etag)
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                cdn.count(requests=1)
+                path, _, query = self.path.partition('?')
+                name = path.rsplit('/', 1)[-1]
+                live = 'type=live' in query
+                if path == '/stats':
+                    return self.send(json.dumps(cdn.stats).encode(), content_type='application/json')
+                if path.startswith(cdn.base) and name in ('master_playlist.m3u8', 'master_dynamic_playlist.m3u8'):
+                    sub = 'dynamic_playlist.m3u8?type=live' if live else 'playlist_1720000000.m3u8'
+                    return self.send(f'#EXTM3U\n#EXT-X-STREAM-INF:BANDWIDTH=128000\n{cdn.transcode_base}{sub}\n'.encode())
+                if path.startswith(cdn.transcode_base) and name == 'playlist_1720000000.m3u8':
+                    with cdn.lock:
+                        not_found = cdn.sub_404 > cdn.stats['sub_404']
+                        cdn.stats['sub_404'] += not_found
+                    if not_found:
+                        return self.send(b'Not Found', 404, 'text/plain')
+                    available = cdn.available()
+                    # like the real sub playlist, it's static and already has the end tag
+                    return self.send(cdn.media_playlist(0, available).encode())
+                if name == 'dynamic_playlist.m3u8':
+                    available = cdn.available()
+                    return self.send_playlist(cdn.media_playlist(max(0, available - 5), available, '?type=live', available >= cdn.segments).encode())
+                if path.startswith(cdn.base) and name.startswith('key_'):
+                    time.sleep(cdn.latency)
+                    cdn.count(keys=1)
+                    return self.send(cdn.key(int(name[4:].split('.')[0])), content_type='application/octet-stream')
+                if path.startswith(cdn.base) and name.startswith('chunk_'):
+                    i = int(name.split('_')[2])
+                    time.sleep(cdn.latency)
+                    if i >= cdn.available():
+                        return self.send(b'Not Found', 404, 'text/plain')
+                    if cdn.chance(cdn.throttle):
+                        cdn.count(throttled=1)
+                        return self.send(b'Too Many Requests', 429, 'text/plain')
+                    corrupt = cdn.chance(cdn.corrupt)
+                    cdn.count(corrupted=corrupt)
+                    body = cdn.chunk(i, corrupt)
+                    if cdn.chance(cdn.truncate):
+                        cdn.count(truncated=1)
+                        return self.send(body[:len(body) // 2], content_type='application/octet-stream', declared=len(body))
+                    cdn.count(chunks=1, bytes=len(body))
+                    return self.send(body, content_type='application/octet-stream')
+                self.send(b'Not Found', 404, 'text/plain')
+
+        server = ThreadingHTTPServer(('127.0.0.1', port), Handler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
+
+    def playlist_url(self, port, live=False):
+        """URL to give to tslazer -d"""
+        if live:
+            name = 'dynamic_playlist.m3u8?type=live' if self.media == 'audio' else 'master_dynamic_playlist.m3u8?type=live'
+        else:
+            name = 'master_playlist.m3u8'
+        return f'http://127.0.0.1:{port}{self.base}{name}'
+
+
+def add_arguments(parser):
+    parser.add_argument("--media", choices=['audio', 'video'], default='audio', help="Serve a space (ADTS chunks) or a broadcast (TS chunks)")
+    parser.add_argument("--segments", type=int, default=200, help="Number of chunks")
+    parser.add_argument("--segment-seconds", type=float, default=3.0, help="Duration of each chunk")
+    parser.add_argument("--live", action='store_true', help="Make chunks available over time, as if the stream is running")
+    parser.add_argument("--speed", type=float, default=10.0, help="How much faster than real time chunks become available with --live")
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds to wait before answering each chunk/key request")
+    parser.add_argument("--bandwidth", help="Max rate of each chunk response, e.g. 500K or 2M (bytes/s)")
+    parser.add_argument("--throttle", type=float, default=0.0, help="Probability of answering a chunk request with 429")
+    parser.add_argument("--sub-404", type=int, default=0, help="Number of sub playlist requests answered with 404")
+    parser.add_argument("--truncate", type=float, default=0.0, help="Probability of truncating a chunk response (size mismatch)")
+    parser.add_argument("--aes-rotate", type=int, default=0, help="Encrypt chunks with AES-128, rotating the key every N chunks (0: no encryption)")
+    parser.add_argument("--corrupt", type=float, default=0.0, help="Probability of zeroing 400 bytes in the middle of a chunk (same size, only frame validation notices)")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed for the injected faults")
+
+
+def from_arguments(args):
+    return MockCDN(args.media, args.segments, args.segment_seconds, args.live, args.speed, args.latency,
+                   parse_size(args.bandwidth) if args.bandwidth else None, args.throttle, args.sub_404,
+                   args.truncate, args.aes_rotate, args.seed, args.corrupt)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Mock pscp.tv HLS server for benchmarking tslazer")
+    parser.add_argument("--port", type=int, default=8080)
+    add_arguments(parser)
+    args = parser.parse_args()
+    cdn = from_arguments(args)
+    server = cdn.serve(args.port)
+    print(f"Serving {args.segments} {args.media} chunks. Use:\n  tslazer -d \"{cdn.playlist_url(args.port, args.live)}\"")
+    print(f"Stats: http://127.0.0.1:{args.port}/stats")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
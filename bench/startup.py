@@ -0,0 +1,79 @@
+# Startup budget check for tslazer.py, so import-time work doesn't creep back in.
+# Measures the wall time of short invocations against a bare interpreter, and checks that
+# heavy modules are only imported by the paths that need them (using python -X importtime).
+#
+#   python bench/startup.py              # exits with 1 if over budget
+#   python bench/startup.py --budget 30  # max extra milliseconds over `python -c pass`
+import argparse
+import statistics
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+import mock_server
+
+TSLAZER = Path(__file__).resolve().parent.parent / 'tslazer.py'
+
+# modules that must not be imported when only parsing arguments
+HEAVY = {'requests', 'urllib3', 'm3u8', 'Crypto', 'httpx', 'websockets', 'pyarrow', 'sqlite3',
+         'TwitterSpace', 'BatchRunner', 'HostWatcher', 'WebSocketHandler', 'AsyncDownloader', 'numpy', 'Validator', 'TSRemuxer', 'boto3', 'botocore', 'SegmentCache'}
+# modules that must not be imported by a --simulate run of an unencrypted stream without chat
+NOT_FOR_SIMULATE = {'Crypto', 'httpx', 'websockets', 'pyarrow', 'numpy', 'WebSocketHandler', 'AsyncDownloader', 'Validator', 'TSRemuxer', 'boto3', 'botocore'}
+
+
+def wall_time(command, runs):
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+
+def imported_modules(args):
+    """Top-level names of the modules imported by tslazer.py with args."""
+    r = subprocess.run([sys.executable, '-X', 'importtime', str(TSLAZER), *args], capture_output=True, text=True)
+    modules = set()
+    for line in r.stderr.splitlines():
+        if line.startswith('import time:') and '|' in line:
+            modules.add(line.rsplit('|', 1)[1].strip().split('.')[0])
+    return modules
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check the startup time of tslazer.py")
+    parser.add_argument("--budget", type=float, default=50, help="Max milliseconds tslazer.py --help may take over `python -c pass` (default: 50)")
+    parser.add_argument("--runs", type=int, default=10, help="Number of runs to take the median of")
+    args = parser.parse_args()
+    failed = False
+
+    baseline = wall_time([sys.executable, '-c', 'pass'], args.runs)
+    help_time = wall_time([sys.executable, str(TSLAZER), '--help'], args.runs)
+    overhead = (help_time - baseline) * 1000
+    print(f"python -c pass:      {baseline * 1000:.0f} ms")
+    print(f"tslazer.py --help:   {help_time * 1000:.0f} ms (+{overhead:.0f} ms, budget +{args.budget:.0f} ms)")
+    if overhead > args.budget:
+        print("FAIL: --help is over budget")
+        failed = True
+
+    if heavy := HEAVY & imported_modules(['--help']):
+        print(f"FAIL: --help imports {', '.join(sorted(heavy))}")
+        failed = True
+
+    cdn = mock_server.MockCDN(segments=10)
+    server = cdn.serve()
+    simulate = ['-d', cdn.playlist_url(server.server_address[1]), '--simulate', '--no-cache']
+    simulate_time = wall_time([sys.executable, str(TSLAZER), *simulate], args.runs)
+    print(f"tslazer.py -S:       {simulate_time * 1000:.0f} ms (against the local mock server)")
+    if heavy := NOT_FOR_SIMULATE & imported_modules(simulate):
+        print(f"FAIL: --simulate imports {', '.join(sorted(heavy))}")
+        failed = True
+    server.shutdown()
+
+    print('FAIL' if failed else 'OK')
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,19 +1,41 @@
 import argparse
-import TwitterSpace
+import sys
 
 
 parser = argparse.ArgumentParser(description="Download Twitter Spaces at lazer fast speeds!", formatter_class=argparse.RawTextHelpFormatter)
 parser.add_argument("--path", "-p", default='.', help="Path to download the space")
 parser.add_argument("--keep", "-k", action='store_true', help="Keep the temporary files")
 parser.add_argument("--cookies", "--cookie", "-c", help="Twitter cookies.txt file (in Netscape format)")
-parser.add_argument("--threads", "-t", type=int, default=20, help="Number of threads to use for downloading")
+parser.add_argument("--threads", "-t", type=int, default=20, help="Max number of threads to use for downloading (or concurrent downloads with --engine async). The actual number adapts to how fast the server responds")
+parser.add_argument("--fixed-threads", action='store_true', help="Always use --threads concurrent downloads instead of adapting it")
+parser.add_argument("--engine", choices=['thread', 'async'], default='thread', help="Download engine. 'async' uses a single event loop with HTTP/2 where supported (requires httpx)")
+parser.add_argument("--max-per-host", type=int, help="Max number of concurrent requests to a single host with --engine async (default: same as --threads)")
+parser.add_argument("--max-buffer", type=int, default=64, help="Memory budget (in MB) for chunks downloaded out of order. Chunks beyond it are spilled to disk")
+parser.add_argument("--limit-rate", help="Max total download rate, e.g. 500K or 10M (bytes/s)")
+parser.add_argument("--edges", nargs='?', const='', metavar="HOSTS", help="Spread chunk downloads over several CDN edges: the playlist's edge, the other providers' edge of the same region (e.g. prod-fastly-* and prod-ec-*), and the comma separated HOSTS if given. Slow or failing edges are evicted")
+parser.add_argument("--pipe", action='store_true', help="Stream audio chunks into ffmpeg as they arrive instead of merging them into a temp file first. The m4a is ready right after the last chunk, but interrupted downloads can't be resumed")
+parser.add_argument("--mp4", action='store_true', help="Remux broadcasts into a fast-start fragmented mp4 as the chunks arrive, instead of keeping the .ts. The .ts is deleted afterwards unless --keep is used")
+parser.add_argument("--storage", metavar="URL", help="Upload the output to an S3-compatible bucket, e.g. s3://archive/spaces, streaming it while downloading instead of writing it to --path (requires boto3). Credentials are read from the usual AWS environment variables or ~/.aws")
+parser.add_argument("--s3-endpoint", metavar="URL", help="Endpoint of the S3-compatible service for --storage (e.g. http://127.0.0.1:9000 for MinIO). Default: AWS")
+parser.add_argument("--start", help="Only download from this point on: an offset like 1:30:00 or 5400, or a wall-clock time like 2024-05-01T21:30:00+09:00 (local time if no timezone is given). Only the chunks covering --start/--end are downloaded. Video is cut at chunk boundaries")
+parser.add_argument("--end", help="Only download up to this point (same formats as --start)")
+parser.add_argument("--validate", action='store_true', help="Check the merged audio/video frame by frame before remuxing (ADTS frames or TS sync bytes and continuity counters, and each chunk's duration against the playlist). Uses numpy if it's installed")
+parser.add_argument("--refetch-bad", action='store_true', help="Like --validate, and download the chunks that fail the check again")
 parser.add_argument("--simulate", "-S", action='store_true', help="Simulate the download process")
+parser.add_argument("--live", "-l", action='store_true', help="Download chunks while the Space/Broadcast is still running, instead of waiting for it to end")
+parser.add_argument("--cache-dir", help="Directory to cache guest tokens and metadata in (default: ~/.cache/tslazer)")
+parser.add_argument("--no-cache", action='store_true', help="Don't cache guest tokens and metadata between runs")
+parser.add_argument("--segment-cache", nargs='?', const='', metavar="DIR", help="Keep downloaded chunks in a cache shared by all runs (default DIR: ~/.cache/tslazer/segments), and take chunks from it instead of the CDN when the same stream is downloaded again (e.g. by --dyn_url and by Space ID)")
+parser.add_argument("--segment-cache-size", default='10G', help="Max size of the segment cache, e.g. 500M or 20G. The least recently used chunks are evicted (default: 10G)")
+parser.add_argument("--metrics-json", metavar="FILE", help="Write stage timings, chunk latencies, retries and throughput of the run to FILE as JSON")
+parser.add_argument("--metrics-prom", metavar="FILE", help="Write the same metrics to FILE in the Prometheus text format (e.g. for the node_exporter textfile collector)")
 parser.add_argument("--debug", action='store_true', help="Enable debug logging. Will be automatically enabled if --simulate is used")
 
 spaceID_group = parser.add_argument_group("Downloading from a Space/Broadcast ID/URL")
 spaceID_group.add_argument("--space_id", "-s", help="Twitter Space/Broadcast ID or URL")
 spaceID_group.add_argument("--video", "--broadcast", "-v", "-b", action='store_true', help="Assume type is broadcast (instead of space) when only the ID is given. It is auto inferred if the full URL is given.")
 spaceID_group.add_argument("--withchat", action='store_true', help="Export the Twitter Space's Chat")
+spaceID_group.add_argument("--chat-format", nargs='+', choices=['txt', 'jsonl', 'parquet'], default=['txt'], help="Chat export format(s). jsonl has one decoded record per message, parquet requires pyarrow (default: txt)")
 
 filename_format_default = "{datetime:%y%m%d} @{host_username} {space_title}-twitter-{type}-{space_id}"
 filename_format_options = """
@@ -31,13 +53,72 @@ spaceID_group.add_argument("--filename-format", "-f", default=filename_format_de
 dyn_group = parser.add_argument_group("Downloading from a dynamic or master URL")
 dyn_group.add_argument("--dyn_url", "-d", help="Twitter Space Master URL or Dynamic Playlist URL")
 dyn_group.add_argument("--filename", "-o", help="Filename for the Twitter Space (default: twitter_{type}_{current_time:%%Y%%m%%d_%%H%%M%%S})")
+batch_group = parser.add_argument_group("Batch mode")
+batch_group.add_argument("--batch", metavar="FILE", help="Download every Space/Broadcast ID, URL or master/dynamic URL listed in FILE (one per line), sharing one session")
+batch_group.add_argument("--follow", action='store_true', help="Keep watching the batch file for new lines")
+batch_group.add_argument("--watch", metavar="FILE", help="Watch the hosts whose @handles are listed in FILE (one per line), and download their Spaces as soon as they go live (add --live to capture them while running). Runs until stopped")
+batch_group.add_argument("--watch-interval", type=float, default=60, help="Seconds between checks of a host with no upcoming Space with --watch. Hosts are checked every 10 seconds from 5 minutes before a scheduled Space starts (default: 60)")
+batch_group.add_argument("--jobs", "-j", type=int, default=2, help="Max number of Spaces/Broadcasts being downloaded at the same time in batch mode")
 args = parser.parse_args()
+if not (args.space_id or args.dyn_url or args.batch or args.watch):
+    parser.error("one of --space_id, --dyn_url, --batch or --watch is required")
+
+# imported only after parsing, so --help and argument errors don't pay for requests, m3u8 etc.
+import TwitterSpace
+from DiskCache import DiskCache
+from Metrics import Metrics
+from utils import RateLimiter, parse_size, parse_time
 
-TwitterSpace.TwitterSpace(
-    url_or_space_id=args.space_id, filename_format=args.filename_format,
-    dyn_url=args.dyn_url, filename=args.filename,
-    path=args.path, with_chat=args.withchat, keep_temp=args.keep,
-    cookies=args.cookies, simulate=args.simulate,
-    type_="broadcast" if args.video else "space", threads=args.threads,
-    debug=args.debug or args.simulate
+try:
+    clip = {name: parse_time(value) for name, value in (('start', args.start), ('end', args.end)) if value}
+except ValueError as e:
+    parser.error(f'invalid --start/--end: {e}')
+
+options = dict(
+    filename_format=args.filename_format, path=args.path, with_chat=args.withchat, chat_formats=args.chat_format, keep_temp=args.keep,
+    cookies=args.cookies, simulate=args.simulate, type_="broadcast" if args.video else "space",
+    live=args.live, max_buffer=args.max_buffer, engine=args.engine, max_per_host=args.max_per_host, pipe=args.pipe, mp4=args.mp4,
+    validate=args.validate, refetch=args.refetch_bad,
+    edges=None if args.edges is None else [host.strip() for host in args.edges.split(',') if host.strip()],
+    cache=None if args.no_cache else DiskCache(args.cache_dir), metrics=Metrics(), **clip
 )
+if args.segment_cache is not None:
+    from SegmentCache import SegmentCache
+    options['segment_cache'] = SegmentCache(args.segment_cache or None, parse_size(args.segment_cache_size), debug=args.debug)
+if args.storage:
+    # shared by all jobs in batch mode
+    from Storage import open_storage
+    try:
+        options['storage'] = open_storage(args.storage, endpoint_url=args.s3_endpoint, debug=args.debug)
+    except (ImportError, ValueError) as e:
+        parser.error(str(e))
+limit_rate = parse_size(args.limit_rate) if args.limit_rate else None
+
+try:
+    if args.watch:
+        import HostWatcher
+        HostWatcher.HostWatcher(
+            args.watch, interval=args.watch_interval, jobs=args.jobs, threads=args.threads, adaptive=not args.fixed_threads,
+            limit_rate=limit_rate, debug=args.debug or args.simulate, **options
+        ).run()
+    elif args.batch:
+        import BatchRunner
+        BatchRunner.BatchRunner(
+            args.batch, jobs=args.jobs, follow=args.follow, threads=args.threads, adaptive=not args.fixed_threads,
+            limit_rate=limit_rate, debug=args.debug or args.simulate, **options
+        ).run()
+    else:
+        space = TwitterSpace.TwitterSpace(
+            url_or_space_id=args.space_id, dyn_url=args.dyn_url, filename=args.filename,
+            threads=args.threads, adaptive=not args.fixed_threads, debug=args.debug or args.simulate,
+            rate_limiter=RateLimiter(limit_rate) if limit_rate else None, **options
+        )
+        # failed, interrupted or not validated downloads are reported above, also tell scripts about them
+        if space.output is None and not args.simulate:
+            sys.exit(1)
+finally:
+    # also written when the run fails, that's when it's most interesting
+    if args.metrics_json:
+        options['metrics'].write_json(args.metrics_json)
+    if args.metrics_prom:
+        options['metrics'].write_prometheus(args.metrics_prom)
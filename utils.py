@@ -1,10 +1,16 @@
+import hashlib
+import json
+import os
+import random
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta, timezone
 from http.cookiejar import MozillaCookieJar
 from pathlib import Path
 from shutil import copyfileobj
 
 import requests
-from Crypto.Cipher import AES
-from Crypto.Util.Padding import unpad
 from requests.adapters import HTTPAdapter
 from urllib3.util.retry import Retry
 
@@ -15,6 +21,7 @@ def requests_retry_session(
     backoff_factor=0.2,
     status_forcelist=None, # (500, 502, 504)
     session=None,
+    pool_maxsize=10,
 ):
     session = session or requests.Session()
     retry = Retry(
@@ -22,7 +29,7 @@ def requests_retry_session(
         backoff_factor=backoff_factor,
         status_forcelist=status_forcelist,
     )
-    adapter = HTTPAdapter(max_retries=retry)
+    adapter = HTTPAdapter(max_retries=retry, pool_connections=pool_maxsize, pool_maxsize=pool_maxsize)
     session.mount('http://', adapter)
     session.mount('https://', adapter)
     return session
@@ -36,19 +43,397 @@ def safeify(name, ignore_backslash=False):
         name = name.replace(illegal, template[illegal])
     return name
 
-def concat(files, output):
-    output = Path(output)
-    if not output.parent.exists():
-        output.parent.mkdir(parents=True)
-    out = output.open('wb')
-    for i, f in enumerate(files):
-        f = Path(f)
-        fi = f.open('rb')
-        copyfileobj(fi, out)
-        fi.close()
-        print(f'\r{i + 1}/{len(files)} chunks merged.      ', end='')
-    out.close()
-    print()
+def chunk_filename(chunk_url):
+    """Local file name of a chunk, i.e. the last path component without the query string."""
+    return chunk_url.split('?')[0].split('/')[-1]
+
+class SegmentBuffer:
+    """
+    Holds one downloaded chunk while it is streamed in, and computes its sha256 at the same time.
+
+    Small chunks stay in memory, bigger ones are rolled over to a temporary file, so the memory used by each download is bounded.
+    """
+    block_size = 64 * 1024
+
+    def __init__(self, spool_size=2 * 1024 * 1024):
+        self.spool_size = spool_size
+        self.file = tempfile.SpooledTemporaryFile(max_size=spool_size)
+        self.sha256 = hashlib.sha256()
+        self.size = 0
+
+    @property
+    def in_memory(self):
+        return self.size <= self.spool_size
+
+    @property
+    def hexdigest(self):
+        return self.sha256.hexdigest()
+
+    def write(self, data):
+        self.file.write(data)
+        self.sha256.update(data)
+        self.size += len(data)
+
+    def copy_to(self, fp):
+        """Write the chunk to the file object fp, block by block."""
+        self.file.seek(0)
+        copyfileobj(self.file, fp, self.block_size)
+
+    def save(self, f):
+        with open(f, 'wb') as fp:
+            self.copy_to(fp)
+
+    def close(self):
+        self.file.close()
+
+class OrderedWriter:
+    """
+    Write chunks to a file object in playlist order, while they can be put in any order (e.g. from parallel downloads).
+
+    Chunks that arrive out of order are kept in memory until the ones before them are written.
+    Once the buffered chunks exceed max_buffer bytes, further out-of-order chunks are spilled to spill_dir instead.
+    """
+    def __init__(self, fp, spill_dir, max_buffer=64 * 1024 * 1024, start=0, on_write=None):
+        self.fp = fp
+        self.spill_dir = Path(spill_dir)
+        self.max_buffer = max_buffer
+        self.on_write = on_write # called with (index, size, sha256 hexdigest) after each chunk is written
+        self.next_index = start
+        self.pending = {}
+        self.spilled = set()
+        self.buffered = 0
+        self.lock = threading.Lock()
+
+    def put(self, index, data):
+        """Put chunk #index, either as bytes or as a SegmentBuffer (which is closed once it's written)."""
+        if isinstance(data, bytes):
+            buffer = SegmentBuffer()
+            buffer.write(data)
+            data = buffer
+        with self.lock:
+            if index != self.next_index:
+                if data.in_memory and self.buffered + data.size <= self.max_buffer:
+                    self.pending[index] = data
+                    self.buffered += data.size
+                else:
+                    f = self.spill_dir / f'{index}.spill'
+                    data.save(f)
+                    data.close()
+                    self.pending[index] = f
+                    self.spilled.add(index)
+                return
+            self._write(data)
+            self._drain()
+
+    def put_file(self, index, f):
+        """Put chunk #index which is already saved at f. The file is left as it is."""
+        with self.lock:
+            self.pending[index] = Path(f)
+            self._drain()
+
+    def _write(self, buffer):
+        buffer.copy_to(self.fp)
+        buffer.close()
+        self.on_write and self.on_write(self.next_index, buffer.size, buffer.hexdigest)
+        self.next_index += 1
+
+    def _write_file(self, f):
+        # copy block by block, hashing on the way, instead of reading the whole file into memory
+        sha256 = hashlib.sha256()
+        size = 0
+        with f.open('rb') as fi:
+            while data := fi.read(SegmentBuffer.block_size):
+                self.fp.write(data)
+                sha256.update(data)
+                size += len(data)
+        self.on_write and self.on_write(self.next_index, size, sha256.hexdigest())
+        self.next_index += 1
+
+    def _drain(self):
+        while self.next_index in self.pending:
+            item = self.pending.pop(self.next_index)
+            if isinstance(item, Path):
+                index = self.next_index
+                self._write_file(item)
+                if index in self.spilled:
+                    self.spilled.remove(index)
+                    item.unlink()
+            else:
+                self.buffered -= item.size
+                self._write(item)
+
+    def close(self):
+        assert not self.pending, f"Chunk {self.next_index} is missing, {len(self.pending)} chunks after it are not written!"
+        self.fp.flush()
+
+class Tee:
+    """
+    File object that writes to fp, and copies everything to the other file objects (e.g. a TSRemuxer) on the way.
+
+    A copy that fails is dropped (and its exception kept in errors) without failing the writes to fp.
+    """
+    def __init__(self, fp, *copies):
+        self.fp = fp
+        self.copies = list(copies)
+        self.errors = {}
+
+    def write(self, data):
+        n = self.fp.write(data)
+        for copy in list(self.copies):
+            try:
+                copy.write(data)
+            except Exception as e:
+                self.errors[copy] = e
+                self.copies.remove(copy)
+        return n
+
+    def flush(self):
+        self.fp.flush()
+
+class Manifest:
+    """
+    On-disk record of the chunks written to a merged file (in order, with their sizes and checksums),
+    so an interrupted download can be resumed without downloading the verified chunks again.
+    """
+    def __init__(self, f):
+        self.f = Path(f)
+        self.data = json.loads(self.f.read_text(encoding='utf-8')) if self.f.exists() else {}
+        self.data.setdefault('segments', [])
+
+    @property
+    def filename(self):
+        return self.data.get('filename')
+
+    def verify(self, names, merged, chunk_dir):
+        """
+        Check the recorded chunks against the merged file, and truncate it after the last verified chunk in order.
+
+        Verified chunks after a bad or missing one are saved to chunk_dir, so they don't have to be downloaded again either.
+
+        :param names: file names of all chunks in the playlist, in order
+        :param merged: the merged file
+        :param chunk_dir: directory to save the verified chunks that can't be kept in place
+        :returns: number of leading chunks that are kept in the merged file
+        """
+        merged = Path(merged)
+        segments = self.data['segments']
+        if not merged.exists():
+            self.data['segments'] = []
+            return 0
+        wanted = set(names)
+        verified = 0
+        offset = 0
+        with merged.open('r+b') as fp:
+            for i, seg in enumerate(segments):
+                data = fp.read(seg['size'])
+                if len(data) != seg['size'] or hashlib.sha256(data).hexdigest() != seg['sha256']:
+                    continue
+                if i == verified and i < len(names) and names[i] == seg['uri']:
+                    verified += 1
+                    offset += seg['size']
+                elif seg['uri'] in wanted:
+                    (Path(chunk_dir) / seg['uri']).write_bytes(data)
+            fp.truncate(offset)
+        self.data['segments'] = segments[:verified]
+        return verified
+
+    def record(self, uri, size, sha256, duration=None):
+        self.data['segments'].append({'uri': uri, 'size': size, 'sha256': sha256, 'duration': duration})
+
+    def save(self):
+        temp = self.f.with_name(self.f.name + '.tmp')
+        temp.write_text(json.dumps(self.data), encoding='utf-8')
+        os.replace(temp, self.f)
+
+    def remove(self):
+        self.f.unlink(missing_ok=True)
+
+class AIMDController:
+    """
+    Adaptive limit for the number of concurrent downloads (additive increase, multiplicative decrease).
+
+    After every window of successful downloads, the limit is raised by one if the throughput improved and the latency stayed flat.
+    It's halved on timeouts, 429/5xx responses and size mismatches, which usually mean the CDN is throttling us.
+    Use it as a context manager around each request to wait for a free slot.
+    """
+    def __init__(self, maximum=20, start=4, minimum=1, adaptive=True, debug=False):
+        self.maximum = maximum
+        self.minimum = minimum
+        self.adaptive = adaptive
+        self.limit = min(start, maximum) if adaptive else maximum
+        self.debug = debug
+        self.active = 0
+        self.cond = threading.Condition()
+        self.last_throughput = 0
+        self.base_latency = None
+        self.last_decrease = 0
+        self._reset_window()
+
+    def _reset_window(self):
+        self.window_start = time.time()
+        self.window_count = 0
+        self.window_bytes = 0
+        self.window_latency = 0
+
+    def _set_limit(self, limit, reason):
+        limit = max(self.minimum, min(self.maximum, limit))
+        if limit != self.limit:
+            self.debug and print(f'\n[DEBUG] concurrency {self.limit} -> {limit} ({reason})')
+            self.limit = limit
+            self.cond.notify_all()
+
+    def __enter__(self):
+        with self.cond:
+            while self.active >= self.limit:
+                self.cond.wait()
+            self.active += 1
+
+    def __exit__(self, *exc):
+        self.release()
+
+    def try_acquire(self):
+        """Take a slot if one is free, without waiting."""
+        with self.cond:
+            if self.active >= self.limit:
+                return False
+            self.active += 1
+            return True
+
+    def release(self):
+        with self.cond:
+            self.active -= 1
+            self.cond.notify()
+
+    def success(self, latency, size):
+        """Record a successful request which took latency seconds and transferred size bytes."""
+        if not self.adaptive:
+            return
+        with self.cond:
+            self.window_count += 1
+            self.window_bytes += size
+            self.window_latency += latency
+            if self.window_count < max(self.limit, 8):
+                return
+            throughput = self.window_bytes / max(time.time() - self.window_start, 1e-6)
+            latency = self.window_latency / self.window_count
+            if self.base_latency is None or latency < self.base_latency:
+                self.base_latency = latency
+            stats = f'{throughput / 1024 / 1024:.2f} MB/s, latency {latency * 1000:.0f} ms'
+            if latency > self.base_latency * 2:
+                self._set_limit(self.limit - 1, f'latency rising, {stats}')
+            elif throughput >= self.last_throughput * 0.95:
+                self._set_limit(self.limit + 1, f'throughput improving, {stats}')
+            self.last_throughput = throughput
+            self._reset_window()
+
+    def failure(self, reason):
+        """Record a request that failed because of throttling (timeouts, 429/5xx, size mismatch)."""
+        if not self.adaptive:
+            return
+        with self.cond:
+            # only back off once for a burst of failures
+            if time.time() - self.last_decrease > 1:
+                self.last_decrease = time.time()
+                self._set_limit(self.limit // 2, reason)
+            self._reset_window()
+
+class RateLimiter:
+    """Token bucket limiting the total download rate (bytes/s), shared by all downloads."""
+    def __init__(self, rate):
+        self.rate = rate
+        self.allowance = rate
+        self.last = time.time()
+        self.lock = threading.Lock()
+
+    def reserve(self, size):
+        """Take size bytes from the bucket, and return how long (seconds) to wait before downloading more."""
+        with self.lock:
+            now = time.time()
+            self.allowance = min(self.rate, self.allowance + (now - self.last) * self.rate)
+            self.last = now
+            self.allowance -= size
+            return max(0, -self.allowance / self.rate)
+
+def parse_size(size):
+    """Parse a size like '500K' or '10M' (bytes, 1024-based) into an int."""
+    size = size.strip().upper().removesuffix('B')
+    units = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+    if size and size[-1] in units:
+        return int(float(size[:-1]) * units[size[-1]])
+    return int(size)
+
+def parse_time(value):
+    """
+    Parse a clip boundary given to --start/--end.
+
+    :param value: an offset into the stream like '90', '1:30' or '1:02:03.5', or a wall-clock time like '2024-05-01T21:30:00+09:00' (local time if no timezone is given)
+    :returns: the offset in seconds (float), or an aware datetime
+    """
+    value = value.strip()
+    if '-' in value[1:] or 'T' in value:
+        t = datetime.fromisoformat(value.replace('Z', '+00:00'))
+        return t if t.tzinfo else t.astimezone()
+    seconds = 0.0
+    for part in value.split(':'):
+        seconds = seconds * 60 + float(part)
+    return seconds
+
+def select_range(chunks, start=None, end=None, stream_start=None):
+    """
+    Select the chunks covering [start, end) of the stream, using the cumulative EXTINF durations.
+
+    Wall-clock times are mapped to offsets through the first EXT-X-PROGRAM-DATE-TIME in the playlist, or stream_start if it has none.
+
+    :param chunks: list of chunks (with .duration, and .program_date_time if the playlist has them)
+    :param start: offset in seconds or datetime (None: beginning of the stream)
+    :param end: offset in seconds or datetime (None: end of the stream)
+    :param stream_start: aware datetime of the first chunk, used if the playlist has no program date-time
+    :returns: (selected chunks, offset of start into the first selected chunk, duration of the clip)
+    """
+    offsets = []
+    total = 0.0
+    origin = None
+    for chunk in chunks:
+        # m3u8 only sets program_date_time on the chunk with the tag, and current_program_date_time on the ones after it
+        pdt = getattr(chunk, 'current_program_date_time', None) or getattr(chunk, 'program_date_time', None)
+        if pdt and origin is None:
+            origin = (pdt if pdt.tzinfo else pdt.replace(tzinfo=timezone.utc)) - timedelta(seconds=total)
+        offsets.append(total)
+        total += chunk.duration or 0
+    origin = origin or stream_start
+
+    def to_offset(t, default):
+        if t is None:
+            return default
+        if isinstance(t, datetime):
+            if origin is None:
+                raise ValueError("the playlist has no EXT-X-PROGRAM-DATE-TIME and the start time of the stream is unknown, use offsets instead of wall-clock times")
+            return (t - origin).total_seconds()
+        return t
+
+    start_offset = max(0.0, to_offset(start, 0.0))
+    end_offset = min(total, to_offset(end, total))
+    if start_offset >= end_offset:
+        raise ValueError(f"empty clip: {start_offset:.1f}s to {end_offset:.1f}s of a {total:.1f}s stream")
+    selected = [i for i, chunk in enumerate(chunks) if offsets[i] + (chunk.duration or 0) > start_offset and offsets[i] < end_offset]
+    return [chunks[i] for i in selected], start_offset - offsets[selected[0]], end_offset - start_offset
+
+def throttle_reason(e):
+    """
+    Tell if an exception from requests/httpx looks like the server is throttling us.
+
+    :returns: the reason (e.g. 'HTTP 503' or 'timeout'), or None
+    """
+    status = getattr(getattr(e, 'response', None), 'status_code', None)
+    if status is not None and (status == 429 or status >= 500):
+        return f'HTTP {status}'
+    if isinstance(e, TimeoutError) or 'Timeout' in type(e).__name__:
+        return 'timeout'
+    return None
+
+def retry_delay(retry_count, base=0.5, cap=30):
+    """Exponential backoff with jitter before the retry_count-th retry."""
+    return random.uniform(0.5, 1) * min(cap, base * 2 ** (retry_count - 1))
 
 def load_cookie(filename):
     cj = MozillaCookieJar(filename)
@@ -56,14 +441,37 @@ def load_cookie(filename):
     return {cookie.name: cookie.value for cookie in cj}
 
 
-def decode(bytes_, key, iv):
-    """Decrypt a file using AES CBC with the provided key and IV.
-    Args:
-        bytes_ (bytes): The encrypted data to decrypt.
-        key (bytes): The AES key used for decryption.
-        iv (bytes): The initialization vector used for decryption.
-    Returns:
-        bytes: The decrypted data.
-    """
-    cipher = AES.new(key, AES.MODE_CBC, iv=iv)
-    return unpad(cipher.decrypt(bytes_), AES.block_size)
\ No newline at end of file
+class StreamDecryptor:
+    def __init__(self, key, iv):
+        """
+        AES-CBC decryption of a chunk as its data arrives, instead of decrypting the whole chunk at the end.
+        The last block is held back until finalize(), because it contains the padding.
+
+        :param key: AES key
+        :param iv: initialization vector
+        """
+        # pycryptodome is imported on first use, most streams aren't encrypted
+        from Crypto.Cipher import AES
+        self.cipher = AES.new(key, AES.MODE_CBC, iv=iv)
+        self.block_size = AES.block_size
+        self.pending = b''
+        self.seconds = 0.0 # time spent decrypting
+
+    def update(self, data):
+        """:returns: the decrypted data that is ready so far"""
+        start = time.perf_counter()
+        data = self.pending + data
+        # keep at least one full block, it may be the last one
+        ready = max(len(data) - self.block_size, 0) // self.block_size * self.block_size
+        self.pending = data[ready:]
+        decrypted = self.cipher.decrypt(data[:ready]) if ready else b''
+        self.seconds += time.perf_counter() - start
+        return decrypted
+
+    def finalize(self):
+        """:returns: the rest of the decrypted data without padding. Raises ValueError if the data is incomplete."""
+        from Crypto.Util.Padding import unpad
+        start = time.perf_counter()
+        decrypted = unpad(self.cipher.decrypt(self.pending), self.block_size)
+        self.seconds += time.perf_counter() - start
+        return decrypted